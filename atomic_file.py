@@ -0,0 +1,49 @@
+#!/usr/bin/env python2.5
+# (c) Copyright 2009 Cloudera, Inc.
+
+import os
+import tempfile
+
+def write_atomically(path, write, mode='w'):
+  """
+  Replaces the file at path with what write(f) writes to f, a temporary
+  file in the same directory that is then renamed over path, so readers
+  only ever see the old or the new contents. Creates the directory if
+  needed. Raises IOError or OSError if that fails, leaving path alone.
+  """
+  dir = os.path.dirname(path) or '.'
+  if not os.path.isdir(dir):
+    os.makedirs(dir)
+  (fd, tmp_path) = tempfile.mkstemp(dir=dir)
+  try:
+    f = os.fdopen(fd, mode)
+    try:
+      write(f)
+    finally:
+      f.close()
+    os.rename(tmp_path, path)
+  except:
+    if os.path.exists(tmp_path):
+      os.unlink(tmp_path)
+    raise
+
+
+def test_write_atomically():
+  import shutil
+  root = tempfile.mkdtemp()
+  try:
+    path = os.path.join(root, "sub", "file")
+    write_atomically(path, lambda f: f.write("one"))
+    assert open(path).read() == "one"
+    def fail(f):
+      f.write("partial")
+      raise IOError("disk full")
+    try:
+      write_atomically(path, fail)
+      assert False
+    except IOError:
+      pass
+    assert open(path).read() == "one"
+    assert os.listdir(os.path.dirname(path)) == ["file"]
+  finally:
+    shutil.rmtree(root)
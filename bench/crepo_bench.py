@@ -0,0 +1,207 @@
+#!/usr/bin/env python2.5
+# (c) Copyright 2009 Cloudera, Inc.
+"""
+Benchmarks crepo against a synthetic workspace.
+
+For each workspace size this generates that many local bare "remote"
+repositories and a matching manifest.json, then times init, fetch,
+status, check-dirty, checkout and dump-refs by running crepo.py in a
+subprocess. Every git process crepo starts is counted through
+REPO_TRACE_FILE. Results are printed and saved as JSON so runs of
+different versions can be compared.
+
+  python bench/crepo_bench.py --projects 10,100,1000 --output results.json
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import simplejson
+
+CREPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "crepo.py")
+
+GIT_ENV = {
+  "GIT_AUTHOR_NAME": "crepo bench",
+  "GIT_AUTHOR_EMAIL": "bench@example.com",
+  "GIT_COMMITTER_NAME": "crepo bench",
+  "GIT_COMMITTER_EMAIL": "bench@example.com",
+  }
+
+def git(cwd, *args):
+  env = dict(os.environ)
+  env.update(GIT_ENV)
+  p = subprocess.Popen(("git",) + args, cwd=cwd, env=env,
+                       stdout=subprocess.PIPE)
+  out = p.communicate()[0]
+  if p.returncode != 0:
+    raise Exception("git %s failed in %s" % (" ".join(args), cwd))
+  return out.strip()
+
+def make_template(root, depth, num_files, diverge):
+  """
+  Builds a repository whose master has depth commits over num_files
+  files, plus two branches diverge commits past master: "upstream" (the
+  remote moving ahead) and "local" (local work in the workspace).
+  """
+  path = os.path.join(root, "template")
+  os.makedirs(path)
+  git(path, "init", "-q")
+  for i in xrange(depth):
+    if i == 0:
+      touched = xrange(num_files)
+    else:
+      touched = [i % num_files]
+    for j in touched:
+      f = open(os.path.join(path, "file%d.txt" % j), "a")
+      f.write("commit %d file %d\n" % (i, j))
+      f.close()
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "commit %d" % i)
+  git(path, "branch", "-M", "master")
+
+  for branch in ("upstream", "local"):
+    git(path, "checkout", "-q", "-b", branch, "master")
+    for i in xrange(diverge):
+      f = open(os.path.join(path, "%s.txt" % branch), "a")
+      f.write("%s %d\n" % (branch, i))
+      f.close()
+      git(path, "add", "-A")
+      git(path, "commit", "-q", "-m", "%s %d" % (branch, i))
+  git(path, "checkout", "-q", "master")
+  return path
+
+def make_workspace(root, num_projects, template):
+  """Creates num_projects bare remotes cloned from template and a manifest."""
+  remotes = os.path.join(root, "remotes")
+  work = os.path.join(root, "work")
+  os.makedirs(remotes)
+  os.makedirs(work)
+  projects = {}
+  for i in xrange(num_projects):
+    name = "project%04d" % i
+    git(root, "clone", "-q", "--bare", template,
+        os.path.join(remotes, name + ".git"))
+    projects[name] = {}
+
+  manifest = {
+    "default-remote": "origin",
+    "remotes": {"origin": {"fetch": "file://%s/%%s.git" % remotes}},
+    "projects": projects,
+    }
+  f = open(os.path.join(work, "manifest.json"), "w")
+  simplejson.dump(manifest, f, indent=2)
+  f.close()
+  return (remotes, work, sorted(projects.keys()))
+
+def advance_remotes(remotes, names):
+  """Moves every remote's master to the upstream branch."""
+  for name in names:
+    path = os.path.join(remotes, name + ".git")
+    git(path, "update-ref", "refs/heads/master", "refs/heads/upstream")
+
+def diverge_workspace(work, names):
+  """Gives every other project local commits on its tracking branch."""
+  for name in names[::2]:
+    git(os.path.join(work, name), "reset", "-q", "--hard", "origin/local")
+
+def time_crepo(work, args, jobs):
+  (fd, trace_path) = tempfile.mkstemp(suffix=".jsonl")
+  os.close(fd)
+  env = dict(os.environ)
+  env.update(GIT_ENV)
+  env["REPO_TRACE_FILE"] = trace_path
+  if jobs and args[0] in ("init", "fetch", "checkout"):
+    args = [args[0], "-j", str(jobs)] + args[1:]
+
+  devnull = open(os.devnull, "w")
+  start = time.time()
+  rc = subprocess.call([sys.executable, CREPO] + args, cwd=work, env=env,
+                       stdout=devnull, stderr=devnull)
+  wall = time.time() - start
+  devnull.close()
+
+  f = open(trace_path)
+  subprocesses = len([line for line in f if line.strip()])
+  f.close()
+  os.unlink(trace_path)
+  return {"command": " ".join(args),
+          "exit_code": rc,
+          "wall_time": wall,
+          "subprocesses": subprocesses}
+
+def run_size(root, num_projects, template, jobs):
+  (remotes, work, names) = make_workspace(root, num_projects, template)
+  results = []
+  def run(*args):
+    result = time_crepo(work, list(args), jobs)
+    result["projects"] = num_projects
+    results.append(result)
+    print "%6d projects  %-12s %8.2fs  %6d git processes  (exit %d)" % (
+      num_projects, args[0], result["wall_time"], result["subprocesses"],
+      result["exit_code"])
+
+  run("init")
+  advance_remotes(remotes, names)
+  run("fetch")
+  diverge_workspace(work, names)
+  run("status")
+  run("check-dirty")
+  run("checkout")
+  run("dump-refs")
+  return results
+
+def crepo_version():
+  try:
+    return git(os.path.dirname(CREPO), "describe", "--always", "--dirty")
+  except Exception:
+    return None
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [options]")
+  parser.add_option("--projects", default="10,100,1000",
+                    help="comma separated workspace sizes [%default]")
+  parser.add_option("--depth", type="int", default=20,
+                    help="commits of history per project [%default]")
+  parser.add_option("--files", type="int", default=50,
+                    help="files per project [%default]")
+  parser.add_option("--diverge", type="int", default=3,
+                    help="commits by which local and remote branches " +
+                    "diverge [%default]")
+  parser.add_option("-j", "--jobs", type="int", default=None,
+                    help="-j to pass to init, fetch and checkout")
+  parser.add_option("--output", default="bench_results.json",
+                    help="where to write the JSON results [%default]")
+  parser.add_option("--keep", action="store_true", default=False,
+                    help="keep the generated workspaces")
+  (options, args) = parser.parse_args()
+
+  root = tempfile.mkdtemp(prefix="crepo-bench-")
+  results = []
+  try:
+    template = make_template(root, options.depth, options.files,
+                             options.diverge)
+    for size in [int(n) for n in options.projects.split(",")]:
+      size_root = os.path.join(root, "size%d" % size)
+      results.extend(run_size(size_root, size, template, options.jobs))
+  finally:
+    if options.keep:
+      print "Workspaces kept in %s" % root
+    else:
+      shutil.rmtree(root)
+
+  out = open(options.output, "w")
+  simplejson.dump({"version": crepo_version(),
+                   "depth": options.depth,
+                   "files": options.files,
+                   "diverge": options.diverge,
+                   "jobs": options.jobs,
+                   "results": results}, out, indent=2)
+  out.close()
+  print "Results written to %s" % options.output
+
+if __name__ == "__main__":
+  main()
@@ -1,17 +1,80 @@
 #!/usr/bin/env python2.5
 # (c) Copyright 2009 Cloudera, Inc.
 
+import atexit
 import os
+import re
 import sys
 import optparse
 import manifest
+import git_mux
 import logging
 import textwrap
+import trace
+import workspace_daemon
+import git_command
+import mirror_cache
+import pipeline
+import job_stats
+import simplejson
+import threading
 from git_command import GitCommand
-from git_repo import GitRepo
+from git_repo import GitRepo, TrackingCache
+from atomic_file import write_atomically
+from work_queue import WorkQueue, HostSlots, default_jobs
+
+# Directory, relative to the manifest, where crepo keeps its local state
+STATE_DIR = ".crepo"
+
+def state_path(name):
+  return os.path.join(STATE_DIR, name)
+
+def load_state(name, default):
+  """Loads the JSON state file name, or returns default if there is none."""
+  try:
+    f = open(state_path(name))
+  except IOError:
+    return default
+  try:
+    try:
+      return simplejson.load(f)
+    except ValueError:
+      return default
+  finally:
+    f.close()
+
+def save_state(name, data):
+  """Atomically replaces the JSON state file name with data."""
+  write_atomically(state_path(name), lambda f: simplejson.dump(data, f))
+
+# The MirrorCache shared with other workspaces, if one is configured
+_mirror_cache = None
+
+# Per-project durations of past operations, for longest-first scheduling
+STATS = "stats.json"
+
+def longest_first(man, operation, projects):
+  """
+  Orders (name, project) pairs by how long operation took for them last
+  time, longest first. Projects with no history are estimated from the
+  size of their packs.
+  """
+  stats = job_stats.JobStats(load_state(STATS, {}))
+  return stats.longest_first(
+    operation, projects,
+    lambda name: repo_for_project(man.projects[name]).pack_size())
+
+def record_durations(operation, jobs):
+  """Adds the durations of the jobs that succeeded to the stats file."""
+  stats = job_stats.JobStats(load_state(STATS, {}))
+  for job in jobs:
+    if not job.failed and job.duration is not None:
+      stats.record(operation, job.name, job.duration)
+  save_state(STATS, stats.data)
 
 def load_manifest():
-  return manifest.load_manifest("manifest.json")
+  return manifest.load_manifest("manifest.json",
+                                cache_path=state_path("manifest.cache"))
 
 def help(args):
   """Shows help"""
@@ -27,75 +90,301 @@ def help(args):
 def workdir_for_project(p):
   return p.dir # TODO(todd) add root to manifest
 
+def repo_for_project(p, **kwargs):
+  return GitRepo(workdir_for_project(p), project_name=p.name, **kwargs)
+
 def init(args):
-  """Initializes repository"""
+  """Initializes repository
+
+  Each project is cloned, has its remotes set up and fetched and has its
+  tracking branch checked out independently of the others, on up to
+  -j N projects at once (one per core by default). Projects that
+  already have a .git directory are not cloned again, so re-running init
+  resumes the projects that failed. Pass --per-host N to work on at most
+  N projects of any one remote host at once. Projects that took longest
+  last time are started first."""
+  (options, args) = _remote_parser().parse_args(args)
   man = load_manifest()
+  num_jobs = _num_jobs(options)
+  projects = selected_projects(man, options)
+  if num_jobs > 1:
+    projects = longest_first(man, "init", projects)
+  progress = _Progress(len(projects))
+  preconnect(man, projects)
+
+  queue = WorkQueue(num_jobs, slots=_host_slots(man, options))
+  for (name, project) in projects:
+    job = queue.add(name, init_project, man, name, project, progress,
+                    num_jobs > 1)
+    job.hosts = project_hosts(man, name, project)
+  queue.run()
+  record_durations("init", queue.jobs)
+  return queue.report()
+
+def init_project(man, name, project, progress, quiet=False):
+  """Runs the whole init pipeline for a single project."""
+  repo = repo_for_project(project)
+  cloned = False
+  if not os.path.exists(os.path.join(repo.path, ".git")):
+    progress.update(name, "cloning")
+    clone_project(man, name, project, quiet)
+    cloned = True
+
+  progress.update(name, "setting up remotes")
+  ensure_project_remotes(man, repo, name, project)
+
+  to_fetch = [r for r in project.remotes.keys()
+              if not (cloned and r == project.from_remote)]
+  if to_fetch:
+    progress.update(name, "fetching %s" % ", ".join(to_fetch))
+    mirrors = mirror_paths(man, name, project, to_fetch,
+                           refresh_mirrors(man, [(name, project)],
+                                           {name: to_fetch}))
+    for mirror in mirrors.values():
+      ensure_alternate(repo, mirror)
+    for cmdv in _fetch_commands([], project, repo, to_fetch, mirrors=mirrors):
+      repo.check_command(cmdv[:1] + (quiet and ["-q"] or []) + cmdv[1:])
+
+  progress.update(name, "checking out %s" % project.tracking_branch)
+  ensure_tracking_branch(repo, name, project)
+  ensure_sparse_checkout(repo, project)
+  if repo.dirty_status().dirty:
+    raise Exception("Project %s is dirty; not checking out %s." %
+                    (name, project.tracking_branch))
+  repo.check_command(["checkout"] + (quiet and ["-q"] or []) +
+                     [project.tracking_branch])
+  progress.done(name)
+
+def clone_project(man, name, project, quiet=False):
+  clone_remote = man.remotes[project.from_remote]
+  clone_url = clone_remote.fetch % name
+  cmdv = ["clone", "-o", project.from_remote, "-n"]
+  if quiet:
+    cmdv.append("-q")
+  if project.depth:
+    # A shallow clone only gets one branch, so make it the one we track
+    cmdv.extend(["-b", project.refspec])
+  cmdv.extend(fetch_options(project))
+  mirrors = refresh_mirrors(man, [(name, project)],
+                            {name: [project.from_remote]})
+  if clone_url in mirrors:
+    cmdv.extend(["--reference", mirrors[clone_url]])
+  if project.sparse:
+    cmdv.append("--sparse")
+  p = GitCommand(None, cmdv + [clone_url, project.dir], project_name=name)
+  if p.Wait() != 0:
+    raise Exception("Could not clone %s from %s" % (name, clone_url))
+
+  repo = repo_for_project(project)
+  ensure_sparse_checkout(repo, project)
+  checkout = ["checkout"] + (quiet and ["-q"] or [])
+  if repo.command(["show-ref", "-q", "HEAD"]) != 0:
+    # There is no HEAD (maybe origin/master doesnt exist) so check out the tracking
+    # branch
+    repo.check_command(checkout + ["--track", "-b", project.tracking_branch,
+                                   project.remote_refspec])
+  else:
+    repo.check_command(checkout)
+
+def fetch_options(project, repo=None):
+  """
+  Returns the clone options for the project's depth and filter, or the
+  fetch options if repo is given. Fetches only keep to the depth in
+  repositories that are already shallow, so that a depth added to the
+  manifest never truncates an existing full clone. The filter is only
+  given to clone, which records it as the clone remote's
+  partialclonefilter for later fetches; git refuses --filter for any
+  other remote, and so for fetch --multiple.
+  """
+  options = []
+  if project.depth and (repo is None or repo.is_shallow()):
+    options.append("--depth=%d" % project.depth)
+  if project.filter and repo is None:
+    options.append("--filter=%s" % project.filter)
+  return options
 
-  for (name, project) in man.projects.iteritems():
-    logging.warn("Initializing project: %s" % name)
-    clone_remote = man.remotes[project.from_remote]
-    clone_url = clone_remote.fetch % name
-    p = GitCommand(None, ["clone", "-o", project.from_remote, "-n", clone_url, project.dir])
-    p.Wait()
-
-    repo = GitRepo(workdir_for_project(project))
-    if repo.command(["show-ref", "-q", "HEAD"]) != 0:
-      # There is no HEAD (maybe origin/master doesnt exist) so check out the tracking
-      # branch
-      repo.check_command(["checkout", "--track", "-b", project.tracking_branch,
-                        project.remote_refspec])
+def refresh_mirrors(man, projects, to_fetch=None, num_jobs=1, slots=None):
+  """
+  Creates or updates the mirror of every remote of projects (or, if
+  to_fetch is given, of the remotes it maps each project's name to), up
+  to num_jobs at once, if a mirror cache is configured. Each mirror is refreshed at most once per run. Returns a dict
+  mapping remote URL to mirror path for the mirrors that are up to date;
+  remotes whose mirror failed are left out, and are used directly.
+  """
+  if _mirror_cache is None:
+    return {}
+  # url -> (host, project)
+  urls = {}
+  for (name, project) in projects:
+    if to_fetch is None:
+      remote_names = project.remotes.keys()
+    else:
+      remote_names = to_fetch[name]
+    for remote_name in remote_names:
+      remote = man.remotes[remote_name]
+      urls[remote.fetch % name] = (remote.host_for(name), name)
+  queue = WorkQueue(num_jobs, slots=slots)
+  for (url, (host, name)) in urls.iteritems():
+    queue.add(url, _mirror_cache.refresh, url, name).hosts = \
+      host and (host,) or ()
+  queue.run()
+  mirrors = {}
+  for job in queue.jobs:
+    if job.failed:
+      logging.warn("Not using the mirror of %s: %s" % (job.name, job.error))
     else:
-      repo.check_command(["checkout"])
+      mirrors[job.name] = job.result
+  return mirrors
+
+def mirror_paths(man, name, project, remote_names, mirrors):
+  """Returns a dict mapping those of remote_names with a mirror to its path."""
+  paths = {}
+  for remote_name in remote_names:
+    url = man.remotes[remote_name].fetch % name
+    if url in mirrors:
+      paths[remote_name] = mirrors[url]
+  return paths
 
-  ensure_remotes([])
-  fetch([])
-  checkout_branches([])
+def ensure_alternate(repo, mirror):
+  """
+  Lets the repository borrow objects from a mirror, as clone --reference
+  would have. Mirrors never prune unreachable objects, so the objects a
+  workspace borrows stay there.
+  """
+  objects = os.path.join(mirror, "objects")
+  alternates = os.path.join(repo.path, ".git", "objects", "info", "alternates")
+  try:
+    existing = open(alternates).read().split("\n")
+  except IOError:
+    existing = []
+  if objects in existing:
+    return
+  if not os.path.isdir(os.path.dirname(alternates)):
+    os.makedirs(os.path.dirname(alternates))
+  f = open(alternates, "a")
+  try:
+    f.write(objects + "\n")
+  finally:
+    f.close()
+
+def ensure_sparse_checkout(repo, project):
+  """
+  Makes the repository's sparse-checkout paths match the project's, if
+  it has any. Projects without sparse paths are left alone.
+  """
+  if not project.sparse:
+    return
+  p = repo.command_process(["sparse-checkout", "list"],
+                           capture_stdout=True, capture_stderr=True)
+  if p.Wait() == 0 and sorted(p.stdout.split()) == sorted(project.sparse):
+    return
+  repo.check_command(["sparse-checkout", "set"] + list(project.sparse))
+
+class _Progress(object):
+  """Prints one line per pipeline stage, prefixed with a completion count."""
+  def __init__(self, total):
+    self.total = total
+    self.finished = 0
+    self.lock = threading.Lock()
+
+  def update(self, name, stage):
+    self.lock.acquire()
+    try:
+      print >>sys.stderr, "[%d/%d] %s: %s" % (self.finished, self.total,
+                                              name, stage)
+    finally:
+      self.lock.release()
+
+  def done(self, name):
+    self.lock.acquire()
+    try:
+      self.finished += 1
+    finally:
+      self.lock.release()
+    self.update(name, "done")
 
 def ensure_remotes(args):
   """Ensure that remotes are set up"""
+  (options, args) = _command_parser().parse_args(args)
   man = load_manifest()
-  for (proj_name, project) in man.projects.iteritems():
-    repo = GitRepo(workdir_for_project(project))
-    for remote_name in project.remotes:
-      remote = man.remotes[remote_name]
-      new_url = remote.fetch % proj_name
-
-      p = repo.command_process(["config", "--get", "remote.%s.url" % remote_name],
-                               capture_stdout=True)
-      if p.Wait() == 0:
-        cur_url = p.stdout.strip()
-        if cur_url != new_url:
-          repo.check_command(["config", "--set", "remote.%s.url" % remote_name, new_url])
-      else:
-        repo.check_command(["remote", "add", remote_name, new_url])
+  for (proj_name, project) in selected_projects(man, options):
+    repo = repo_for_project(project)
+    ensure_project_remotes(man, repo, proj_name, project)
+
+def ensure_project_remotes(man, repo, proj_name, project):
+  """
+  Makes the project's remote URLs match the manifest, adding missing
+  remotes with the default fetch refspec. The config is read and written
+  in-process, with every change made in one write, so a project whose
+  remotes are already right costs no git processes at all.
+  """
+  config = repo.config()
+  for remote_name in project.remotes:
+    remote = man.remotes[remote_name]
+    new_url = remote.fetch % proj_name
+
+    url_key = "remote.%s.url" % remote_name
+    if config.get(url_key) is None:
+      config.set(url_key, new_url)
+      config.add("remote.%s.fetch" % remote_name,
+                 "+refs/heads/*:refs/remotes/%s/*" % remote_name)
+    else:
+      config.set(url_key, new_url)
+  config.save()
 
 def ensure_tracking_branches(args):
   """Ensures that the tracking branches are set up"""
+  (options, args) = _command_parser().parse_args(args)
   man = load_manifest()
-  for (name, project) in man.projects.iteritems():
-    repo = GitRepo(workdir_for_project(project))
-    branch_missing = repo.command(
-      ["rev-parse", "--verify", "-q", project.refspec],
-      capture_stdout=True)
-    
-    if branch_missing:
-      logging.warn("Branch %s does not exist in project %s. checking out." %
-                   (project.refspec, name))
-      repo.command(["branch", "--track",
-                    project.tracking_branch, project.remote_refspec])
+  _ensure_tracking_branches(selected_projects(man, options))
+
+def _ensure_tracking_branches(projects):
+  for (name, project) in projects:
+    repo = repo_for_project(project)
+    ensure_tracking_branch(repo, name, project)
+
+def ensure_tracking_branch(repo, name, project):
+  if not repo.has_ref(project.refspec):
+    logging.warn("Branch %s does not exist in project %s. checking out." %
+                 (project.refspec, name))
+    repo.command(["branch", "--track",
+                  project.tracking_branch, project.remote_refspec])
 
 def check_dirty(args):
   """Prints output if any projects have dirty working dirs or indexes."""
+  (options, args) = _report_parser().parse_args(args)
   man = load_manifest()
+  projects = selected_projects(man, options)
+  if options.format == "jsonl":
+    statuses = daemon_statuses([name for (name, project) in projects])
+    jobs = _emit_jsonl(projects, options,
+                       lambda name, project: _dirty_record(
+                         name, project, statuses.get(name)))
+    return [job for job in jobs if job.failed or job.result["dirty"]] and 1 or 0
+  return _check_dirty(projects, _num_jobs(options))
+
+def _check_dirty(projects, num_jobs):
+  statuses = daemon_statuses([name for (name, project) in projects])
+  queue = WorkQueue(num_jobs)
+  for (name, project) in projects:
+    if name not in statuses:
+      queue.add(name, repo_for_project(project).dirty_status)
+  queue.run()
+  for job in queue.jobs:
+    if not job.failed:
+      statuses[job.name] = job.result
+
   any_dirty = False
-  for (name, project) in man.projects.iteritems():
-    repo = GitRepo(workdir_for_project(project))
-    any_dirty = check_dirty_repo(repo) or any_dirty
+  for (name, project) in projects:
+    repo = repo_for_project(project)
+    any_dirty = check_dirty_repo(repo, st=statuses.get(name)) or any_dirty
   return any_dirty
 
-def check_dirty_repo(repo, indent=0):
-  workdir_dirty = repo.is_workdir_dirty()
-  index_dirty = repo.is_index_dirty()
+def check_dirty_repo(repo, indent=0, st=None):
+  if st is None:
+    st = repo.dirty_status()
+  workdir_dirty = st.unstaged
+  index_dirty = st.staged
 
   name = repo.name
   if workdir_dirty:
@@ -106,92 +395,496 @@ def check_dirty_repo(repo, indent=0):
   return workdir_dirty or index_dirty
 
 
+def setup_perf(args):
+  """Turns on git's untracked cache and file system monitor in every project
+
+  Sets core.untrackedCache, so git status remembers which directories have
+  no new files, and core.fsmonitor where this git has a builtin file system
+  monitor (git 2.36 or later, and not on Linux), so status and the dirty checks
+  only look at files that changed. Both are per-project settings and safe
+  to set again."""
+  (options, args) = _command_parser().parse_args(args)
+  man = load_manifest()
+  fsmonitor = None
+  for (name, project) in selected_projects(man, options):
+    repo = repo_for_project(project)
+    if fsmonitor is None:
+      fsmonitor = repo.supports_fsmonitor()
+      if not fsmonitor:
+        print >>sys.stderr, "This git has no builtin file system " + \
+              "monitor; only enabling the untracked cache."
+    settings = [("core.untrackedCache", "true")]
+    if fsmonitor:
+      settings.append(("core.fsmonitor", "true"))
+    config = repo.config()
+    for (key, value) in settings:
+      config.set(key, value)
+    config.save()
+    print >>sys.stderr, "Project %s: set %s" % (
+      name, ", ".join([key for (key, value) in settings]))
+
+def _checkout_parser():
+  parser = _parallel_parser()
+  parser.add_option("-f", "--force", action="store_true", dest="force",
+                    default=False,
+                    help="check out even if some projects are dirty")
+  return parser
+
 def checkout_branches(args):
-  """Checks out the tracking branches listed in the manifest."""
+  """Checks out the tracking branches listed in the manifest.
 
-  ensure_tracking_branches([])
-  if check_dirty([]) and '-f' not in args:
-    raise Exception("Cannot checkout new branches with dirty projects.")
-  
+  Projects are checked out on up to -j N at once (one per core by
+  default), each after its own dirty check. If any project can't be
+  checked out, every project that was switched is put back on the branch
+  or commit it had before, so the workspace is never left half-switched."""
+  (options, args) = _checkout_parser().parse_args(args)
   man = load_manifest()
-  for (name, project) in man.projects.iteritems():
-    print >>sys.stderr, "Checking out tracking branch in project: %s" % name
-    repo = GitRepo(workdir_for_project(project))
-    # Check that sucker out
-    repo.check_command(["checkout", project.tracking_branch])
+  return _run_pipeline(selected_projects(man, options), options,
+                       [ensure_branch_step, check_dirty_step, checkout_step])
 
 def hard_reset_branches(args):
-  """Hard-resets your tracking branches to match the remotes."""
-  checkout_branches(args)
+  """Hard-resets your tracking branches to match the remotes.
+
+  Each project has its tracking branch ensured, checked for dirtiness,
+  checked out and reset in one go, on up to -j N projects at once. As
+  with checkout, if any project fails every project is rolled back."""
+  (options, args) = _checkout_parser().parse_args(args)
   man = load_manifest()
-  for (name, project) in man.projects.iteritems():
-    print >>sys.stderr, "Hard resetting tracking branch in project: %s" % name
-    repo = GitRepo(workdir_for_project(project))
-    repo.check_command(["reset", "--hard", project.remote_refspec])
-  
+  return _run_pipeline(selected_projects(man, options), options,
+                       [ensure_branch_step, check_dirty_step, checkout_step,
+                        reset_step])
+
+def _run_pipeline(projects, options, steps):
+  """Runs steps over projects with the -j and -f options of a command."""
+  contexts = [pipeline.ProjectContext(name, project,
+                                      repo_for_project(project),
+                                      force=options.force)
+              for (name, project) in projects]
+  num_jobs = _num_jobs(options)
+  return pipeline.Pipeline(steps, num_jobs).run(contexts)
+
+def ensure_branch_step(ctx):
+  ensure_tracking_branch(ctx.repo, ctx.name, ctx.project)
+
+def check_dirty_step(ctx):
+  if check_dirty_repo(ctx.repo) and not ctx.force:
+    raise Exception("Project %s is dirty; not checking out %s." %
+                    (ctx.name, ctx.project.tracking_branch))
+
+def checkout_step(ctx):
+  """Checks out the tracking branch, remembering what HEAD was."""
+  prior = ctx.repo.current_head()
+  print >>sys.stderr, "Checking out tracking branch in project: %s" % ctx.name
+  ensure_sparse_checkout(ctx.repo, ctx.project)
+  ctx.repo.check_command(["checkout", "-q"] + (ctx.force and ["-f"] or []) +
+                         [ctx.project.tracking_branch])
+  if prior != ctx.project.tracking_branch:
+    ctx.on_rollback(_restore_head, ctx.name, ctx.repo, prior)
+
+def reset_step(ctx):
+  """Hard-resets the checked out branch to its remote branch."""
+  prior = ctx.repo.rev_parse("HEAD")
+  print >>sys.stderr, "Hard resetting tracking branch in project: %s" % ctx.name
+  ctx.repo.check_command(["reset", "-q", "--hard", ctx.project.remote_refspec])
+  ctx.on_rollback(ctx.repo.check_command, ["reset", "-q", "--hard", prior])
+
+def _restore_head(name, repo, head):
+  print >>sys.stderr, "Restoring %s in project %s" % (head, name)
+  # A sha is checked out as a detached HEAD, like the one it came from
+  repo.check_command(["checkout", "-q", head])
+
+
+def _command_parser(usage=None):
+  """
+  Returns an OptionParser that understands the project selection options
+  every command takes. Options stop at the first positional argument.
+  """
+  parser = optparse.OptionParser(usage=usage)
+  parser.disable_interspersed_args()
+  parser.add_option("-s", "--select", action="append", dest="selectors",
+                    default=[], metavar="SELECTOR",
+                    help="only act on the matching projects; may be given " +
+                    "more than once or as a comma separated list. A " +
+                    "selector is a project name or glob, group:GROUP (or " +
+                    "@GROUP), dir:GLOB, or changed-since:SNAPSHOT")
+  return parser
+
+def selected_projects(man, options):
+  """
+  Returns the (name, project) pairs chosen by the -s options, without
+  running git.
+  """
+  selectors = []
+  for selector in options.selectors:
+    selectors.extend([s for s in selector.split(",") if s])
+  return man.select(selectors, current_revision=_current_revision)
+
+def _current_revision(project):
+  refs = repo_for_project(project).refs
+  return refs and refs.resolve("HEAD")
+
+def _parallel_parser(usage=None):
+  """
+  Returns an OptionParser that understands the options shared by every
+  command that can run across projects in parallel.
+  """
+  parser = _command_parser(usage)
+  parser.add_option("-j", "--jobs", type="int", dest="jobs", default=None,
+                    help="run up to JOBS projects at once (one per core " +
+                    "by default; -j 1 runs them one at a time)")
+  parser.add_option("-p", "--parallel", action="store_true", dest="parallel",
+                    default=False,
+                    help="run one job per core (the default)")
+  return parser
+
+def _add_output_option(parser):
+  """
+  Adds -o to parser, for the commands that run their git commands
+  through a GitMux.
+  """
+  parser.add_option("-o", "--output", type="choice", dest="output",
+                    choices=git_mux.MODES, default=None,
+                    help="how to show the output of parallel git commands: " +
+                    "prefix each line with the project (the default), " +
+                    "buffer it per project, or pass it through directly")
+  return parser
+
+def _num_jobs(options):
+  if options.jobs is not None:
+    return max(1, options.jobs)
+  return default_jobs()
+
+def _remote_parser(usage=None):
+  """
+  Returns a _parallel_parser for commands that talk to remotes, which
+  also understands --per-host.
+  """
+  parser = _parallel_parser(usage)
+  parser.add_option("--per-host", type="int", dest="per_host", default=None,
+                    metavar="N",
+                    help="talk to any one remote host from at most N " +
+                    "projects at once; a remote's max-jobs overrides this")
+  return parser
+
+def _host_slots(man, options):
+  return HostSlots(options.per_host, manifest.host_limits(man))
+
+def project_hosts(man, name, project, remote_names=None):
+  """
+  Returns the hosts of the project's remotes (or of those in
+  remote_names), leaving out local remotes.
+  """
+  if remote_names is None:
+    remote_names = project.remotes.keys()
+  hosts = [man.remotes[r].host_for(name) for r in remote_names]
+  return tuple(set([h for h in hosts if h]))
+
+def preconnect(man, projects, remote_names=None):
+  """
+  Opens one shared ssh connection per ssh host among the projects'
+  remotes, which every git command crepo runs afterwards reuses. The
+  connections are opened in parallel, so an unreachable host costs at
+  most one connect timeout.
+  """
+  targets = set()
+  for (name, project) in projects:
+    for remote_name in project.remotes.keys():
+      if remote_names is not None and remote_name not in remote_names:
+        continue
+      url = man.remotes[remote_name].fetch % name
+      if manifest.is_ssh_url(url):
+        (scheme, user, host, port) = manifest.parse_url(url)
+        targets.add((user and "%s@%s" % (user, host) or host, port))
+  if not targets:
+    return
+  queue = WorkQueue(len(targets))
+  for (target, port) in sorted(targets):
+    queue.add(target, git_command.open_ssh_master, target, port)
+  queue.run()
+  for job in queue.jobs:
+    if job.failed or not job.result:
+      logging.warn("Could not open a shared connection to %s" % job.name)
+
+def _output_mode(options, num_jobs):
+  if options.output:
+    return options.output
+  if num_jobs > 1:
+    return git_mux.PREFIX
+  return git_mux.DIRECT
+
+def _queue_all(man, projects, options, num_jobs, commands_for_project,
+               hosts_for_project=None, slots=None, operation=None,
+               keep_stderr=False):
+  """
+  Runs the git commands returned by commands_for_project(name, project)
+  for each of projects, a list of (name, project) as returned by
+  selected_projects, skipping projects with no commands, with up to
+  num_jobs projects at once. If hosts_for_project is given, each project
+  also waits for room in slots on the hosts it returns. If operation is
+  given, projects run longest first according to its history, which is
+  then updated. With keep_stderr, each job's stderr_tail is kept even in
+  DIRECT mode. Returns the finished GitMux.
+  """
+  mux = git_mux.GitMux(num_jobs, _output_mode(options, num_jobs),
+                       slots=slots, keep_stderr=keep_stderr)
+  if operation and num_jobs > 1:
+    projects = longest_first(man, operation, projects)
+  for (name, project) in projects:
+    cmdvs = commands_for_project(name, project)
+    if not cmdvs:
+      continue
+    hosts = ()
+    if hosts_for_project:
+      hosts = hosts_for_project(name, project)
+    mux.add(name, repo_for_project(project), cmdvs, hosts)
+  mux.run()
+  if operation:
+    record_durations(operation, mux.jobs)
+  return mux
+
+def _run_all(man, options, num_jobs, commands_for_project):
+  """
+  Like _queue_all, but returns the overall exit code.
+  """
+  return _queue_all(man, selected_projects(man, options), options, num_jobs,
+                    commands_for_project).report()
 
 def do_all_projects(args):
   """Run the given git-command in every project
 
-  Pass -p to do it in parallel"""
+  Runs up to -j N projects at once, one per core by default; pass
+  -j 1 to run them one at a time. Parallel output is prefixed with the
+  project name; pass -o buffer to print each project's output whole
+  instead."""
+  (options, args) = _add_output_option(_parallel_parser()).parse_args(args)
+  man = load_manifest()
+  return _run_all(man, options, _num_jobs(options),
+                  lambda name, project: [args])
+
+def fetch(args):
+  """Run git-fetch in every project
+
+  Fetches up to -j N projects at once, one per core by default. All of a
+  project's remotes are fetched by one git fetch --multiple; pass
+  --fetch-jobs N to let git fetch up to N of them at once. Pass -i to only
+  fetch the remotes whose branches or tags have moved since the last
+  incremental fetch, according to a cheap git ls-remote. With a mirror
+  cache, each mirror is updated from its remote first and the projects are
+  then fetched from the mirrors. Pass --per-host N to fetch from at most N
+  projects of any one remote host at once. In parallel, the projects whose
+  fetches took longest last time are started first."""
+  parser = _add_output_option(_remote_parser())
+  parser.add_option("-i", "--incremental", action="store_true",
+                    dest="incremental", default=False,
+                    help="skip remotes whose ref tips have not changed")
+  parser.add_option("--fetch-jobs", type="int", dest="fetch_jobs",
+                    default=None,
+                    help="remotes git fetches at once within a project")
+  (options, args) = parser.parse_args(args)
   man = load_manifest()
+  num_jobs = _num_jobs(options)
+  slots = _host_slots(man, options)
+  projects = selected_projects(man, options)
+  preconnect(man, projects)
+  # Serial fetches pipe stderr to find out which remotes failed, so ask
+  # git to keep showing its progress on the terminal
+  progress = (_output_mode(options, num_jobs) == git_mux.DIRECT and
+              sys.stderr.isatty())
 
-  if args[0] == '-p':
-    parallel = True
-    del args[0]
+  if options.incremental:
+    state = load_state(FETCH_STATE, {})
+    (to_fetch, tips) = _changed_remotes(man, projects, state, num_jobs, slots)
   else:
-    parallel = False
+    to_fetch = dict([(name, project.remotes.keys())
+                     for (name, project) in projects])
 
-  towait = []
+  mirrors = {}
+  if _mirror_cache is not None:
+    mirrored = [(n, p) for (n, p) in projects if to_fetch[n]]
+    urls = refresh_mirrors(man, mirrored, to_fetch, num_jobs, slots)
+    for (name, project) in mirrored:
+      mirrors[name] = mirror_paths(man, name, project, to_fetch[name], urls)
+      repo = repo_for_project(project)
+      for mirror in mirrors[name].values():
+        ensure_alternate(repo, mirror)
 
-  for (name, project) in man.projects.iteritems():
-    repo = GitRepo(workdir_for_project(project))
-    print >>sys.stderr, "In project: ", name, " running ", " ".join(args)
-    p = repo.command_process(args)
-    if not parallel:
-      p.Wait()
-      print >>sys.stderr
-    else:
-      towait.append(p)
+  mux = _queue_all(man, projects, options, num_jobs,
+                   lambda name, project: _fetch_commands(args, project,
+                                                         repo_for_project(project),
+                                                         to_fetch[name],
+                                                         options.fetch_jobs,
+                                                         mirrors.get(name, {}),
+                                                         progress),
+                   lambda name, project: project_hosts(
+                     man, name, project,
+                     [r for r in to_fetch[name] if r not in mirrors.get(name, {})]),
+                   slots, "fetch", keep_stderr=True)
+  fetched = _fetched_remotes(mux, to_fetch)
 
-  for p in towait:
-    p.Wait()
-      
-def do_all_projects_remotes(args):
-  """Run the given git-command in every project, once for each remote.
+  if options.incremental:
+    for (name, remote_names) in fetched.iteritems():
+      project_state = state.setdefault(man.projects[name].dir, {})
+      for remote_name in remote_names:
+        url = man.remotes[remote_name].fetch % name
+        if tips.get(url) is not None:
+          project_state[remote_name] = {"url": url, "refs": tips[url]}
+    save_state(FETCH_STATE, state)
+  return mux.report()
 
-  Pass -p to do it in parallel"""
-  man = load_manifest()
+def _fetch_commands(args, project, repo, remote_names, fetch_jobs=None,
+                    mirrors={}, progress=False):
+  """
+  Returns the git commands that fetch remote_names in one project. Remotes
+  in mirrors, a dict mapping remote name to mirror path, are fetched from
+  their mirror into the usual remote-tracking branches. With progress,
+  git reports progress even though its stderr is not a terminal.
+  """
+  options = fetch_options(project, repo)
+  if progress:
+    options.append("--progress")
+  cmdvs = []
+  for remote_name in remote_names:
+    if remote_name in mirrors:
+      cmdvs.append(args + ["fetch"] + options +
+                   ["file://" + mirrors[remote_name],
+                    "+refs/heads/*:refs/remotes/%s/*" % remote_name])
+  remote_names = [r for r in remote_names if r not in mirrors]
+  if len(remote_names) == 1:
+    cmdvs.append(args + ["fetch"] + options + remote_names)
+  elif remote_names:
+    cmdv = args + ["fetch", "--multiple"] + options
+    if fetch_jobs:
+      cmdv.append("--jobs=%d" % fetch_jobs)
+    cmdvs.append(cmdv + remote_names)
+  return cmdvs
 
-  if args[0] == '-p':
-    parallel = True
-    del args[0]
-  else:
-    parallel = False
-  towait = []
+# Printed by git fetch --multiple for each remote that failed, either as
+# "error: could not fetch origin" or "could not fetch 'origin' (exit code: 1)"
+_FETCH_FAILED_RE = re.compile(r"could not fetch '?([^' ]+)'?", re.I)
 
-  for (name, project) in man.projects.iteritems():
-    repo = GitRepo(workdir_for_project(project))
+def _fetched_remotes(mux, to_fetch):
+  """
+  Works out which remotes of each project were fetched successfully from
+  the results of a combined fetch, printing the ones that failed. Returns
+  a dict mapping project name to its successfully fetched remotes.
+  """
+  fetched = {}
+  for job in mux.jobs:
+    remote_names = to_fetch[job.name]
+    if not job.failed:
+      fetched[job.name] = remote_names
+      continue
+    failed = set()
+    for line in job.stderr_tail:
+      m = _FETCH_FAILED_RE.search(line)
+      if m and m.group(1) in remote_names:
+        failed.add(m.group(1))
+    if not failed:
+      # We couldn't tell which remote failed, so assume they all did
+      failed = set(remote_names)
+    for remote_name in remote_names:
+      if remote_name in failed:
+        print >>sys.stderr, "Could not fetch remote %s in project %s" % (
+          remote_name, job.name)
+    fetched[job.name] = [r for r in remote_names if r not in failed]
+  return fetched
+
+def _changed_remotes(man, projects, state, num_jobs, slots=None):
+  """
+  Compares every remote's current tips with the fetch state and returns
+  (to_fetch, tips): a dict mapping project name to the remotes that need
+  fetching, and the tips returned by remote_tips.
+  """
+  # url -> host, and url -> project
+  urls = {}
+  names = {}
+  for (name, project) in projects:
     for remote_name in project.remotes.keys():
-      cmd = args + [remote_name]
-      print >>sys.stderr, "In project: ", name, " running ", " ".join(cmd)
-      p = repo.command_process(cmd)
-      if not parallel:
-        p.Wait()
-        print >>sys.stderr
+      remote = man.remotes[remote_name]
+      urls[remote.fetch % name] = remote.host_for(name)
+      names[remote.fetch % name] = name
+  tips = remote_tips(urls.keys(), num_jobs, slots, urls, names)
+
+  to_fetch = {}
+  skipped = 0
+  for (name, project) in projects:
+    repo = repo_for_project(project)
+    project_state = state.get(project.dir, {})
+    to_fetch[name] = []
+    for remote_name in project.remotes.keys():
+      url = man.remotes[remote_name].fetch % name
+      if _remote_unchanged(repo, remote_name, url, tips.get(url),
+                           project_state.get(remote_name)):
+        skipped += 1
       else:
-        towait.append(p)
-  for p in towait:
-    p.Wait()
+        to_fetch[name].append(remote_name)
+  print >>sys.stderr, "Skipping %d unchanged remotes." % skipped
+  return (to_fetch, tips)
 
+FETCH_STATE = "fetch-state.json"
 
-def fetch(args):
-  """Run git-fetch in every project"""
-  do_all_projects_remotes(args + ["fetch"])
+def remote_tips(urls, num_jobs=1, slots=None, hosts={}, names={}):
+  """
+  Runs git ls-remote once per distinct url and returns a dict mapping each
+  url to a dict of its branch and tag tips, or to None if the query
+  failed. hosts may map urls to the hosts to limit with slots, and names
+  to the projects to report the queries under.
+  """
+  queue = WorkQueue(num_jobs, slots=slots)
+  for url in set(urls):
+    host = hosts.get(url)
+    queue.add(url, _ls_remote, url, names.get(url)).hosts = \
+      host and (host,) or ()
+  queue.run()
+  return dict([(job.name, job.result) for job in queue.jobs])
+
+def _ls_remote(url, name=None):
+  p = GitCommand(None, ["ls-remote", "--heads", "--tags", url],
+                 capture_stdout=True, project_name=name)
+  if p.Wait() != 0:
+    return None
+  tips = {}
+  for line in p.stdout.split("\n"):
+    if not line:
+      continue
+    (sha, ref) = line.split("\t", 1)
+    tips[ref] = sha
+  return tips
+
+def _remote_unchanged(repo, remote_name, url, tips, recorded):
+  """
+  True if the remote's current tips match those recorded at its last
+  fetch and the local remote-tracking branches still point at them.
+  """
+  if tips is None or not recorded:
+    return False
+  if recorded.get("url") != url or recorded.get("refs") != tips:
+    return False
+  if not repo.refs:
+    return False
+  for (ref, sha) in tips.iteritems():
+    if ref.startswith("refs/heads/"):
+      tracking = "refs/remotes/%s/%s" % (remote_name, ref[len("refs/heads/"):])
+      if repo.refs.read_ref(tracking) != sha:
+        return False
+  return True
 
 def pull(args):
-  """Run git-pull in every project"""
-  do_all_projects(args + ["pull"])
+  """Run git-pull in every project
+
+  Pulls up to -j N projects at once, one per core by default. Pass
+  --per-host N to pull from at most N projects of any one remote host at
+  once."""
+  (options, args) = _add_output_option(_remote_parser()).parse_args(args)
+  man = load_manifest()
+  projects = selected_projects(man, options)
+  preconnect(man, projects,
+             set([project.from_remote for (name, project) in projects]))
+  return _queue_all(man, projects, options, _num_jobs(options),
+                    lambda name, project: [args + ["pull"]],
+                    lambda name, project: project_hosts(
+                      man, name, project, [project.from_remote]),
+                    _host_slots(man, options)).report()
 
 def _format_tracking(local_branch, remote_branch,
                      left, right):
@@ -212,19 +905,44 @@ def _format_tracking(local_branch, remote_branch,
             "%d and %d revisions.") %
             (local_branch, remote_branch, left, right))
 
-def project_status(project, indent=0):
-  repo = GitRepo(workdir_for_project(project))
-  repo_status(repo, project.tracking_branch, project.remote_refspec, indent=indent)
+def project_status(project, indent=0, st=None):
+  repo = repo_for_project(project)
+  repo_status(repo, project.tracking_branch, project.remote_refspec,
+              indent=indent, st=st)
+
+def compare_tracking(repo, tracking_branch, remote_ref, st):
+  """
+  Compares the tracking branch with the remote branch, given the repo's
+  status st. Returns (has_tracking, has_remote, ahead, behind), where ahead
+  and behind count the commits only on the tracking branch and only on
+  the remote branch, and are None if either branch is missing.
+  """
+  if st.branch == tracking_branch and st.upstream == remote_ref:
+    # The status already tells us everything about the branch pair
+    has_tracking = True
+    has_remote = not st.upstream_gone
+    (ahead, behind) = (st.ahead, st.behind)
+  else:
+    has_tracking = repo.has_ref(tracking_branch)
+    has_remote = repo.has_ref(remote_ref)
+    (ahead, behind) = (None, None)
+    if has_tracking and has_remote:
+      (ahead, behind) = repo.tracking_status(tracking_branch, remote_ref)
+  if not has_tracking or not has_remote:
+    (ahead, behind) = (None, None)
+  return (has_tracking, has_remote, ahead, behind)
+
+def repo_status(repo, tracking_branch, remote_ref, indent=0, st=None):
+  if st is None:
+    st = repo.status()
 
-def repo_status(repo, tracking_branch, remote_ref, indent=0):
   # Make sure the right branch is checked out
-  if repo.current_branch() != tracking_branch:
+  if st.branch != tracking_branch:
     print " " * indent + ("Checked out branch is %s instead of %s" %
-                         (repo.current_branch(), tracking_branch))
+                         (st.branch or "a detached HEAD", tracking_branch))
 
-  # Make sure the branches exist
-  has_tracking = repo.has_ref(tracking_branch)
-  has_remote = repo.has_ref(remote_ref)
+  (has_tracking, has_remote, left, right) = compare_tracking(
+    repo, tracking_branch, remote_ref, st)
 
   if not has_tracking:
     print " " * indent + "You appear to be missing the tracking branch " + \
@@ -237,34 +955,122 @@ def repo_status(repo, tracking_branch, remote_ref, indent=0):
     return
 
   # Print tracking branch status
-  (left, right) = repo.tracking_status(tracking_branch, remote_ref)
   text = _format_tracking(tracking_branch, remote_ref, left, right)
   indent_str = " " * indent
   print textwrap.fill(text, initial_indent=indent_str, subsequent_indent=indent_str)
 
 def status(args):
-  """Shows where your branches have diverged from the specified remotes."""
-  ensure_tracking_branches([])
+  """Shows where your branches have diverged from the specified remotes.
+
+  With --format=jsonl, prints one JSON record per project as soon as it
+  is done, checking up to -j N projects at once."""
+  (options, args) = _report_parser().parse_args(args)
   man = load_manifest()
+  projects = selected_projects(man, options)
+  statuses = daemon_statuses([name for (name, project) in projects])
+  if options.format == "jsonl":
+    jobs = _emit_jsonl(projects, options,
+                       lambda name, project: _status_record(
+                         name, project, statuses.get(name)))
+    return [job for job in jobs if job.failed] and 1 or 0
   first = True
-  for (name, project) in man.projects.iteritems():
+  for (name, project) in projects:
     if not first: print
     first = False
 
     print "Project %s:" % name
-    project_status(project, indent=2)
-    check_dirty_repo(GitRepo(workdir_for_project(project)),
-                     indent=2)
+    repo = repo_for_project(project)
+    st = statuses.get(name) or repo.status()
+    if st.branch != project.tracking_branch:
+      ensure_tracking_branch(repo, name, project)
+    project_status(project, indent=2, st=st)
+    check_dirty_repo(repo, indent=2, st=st)
 
   man_repo = get_manifest_repo()
   if man_repo:
     print
     print "Manifest repo:"
-    repo_status(man_repo,
-                man_repo.current_branch(),
-                "origin/" + man_repo.current_branch(),
-                indent=2)
-    check_dirty_repo(man_repo, indent=2)
+    _manifest_repo_status(man_repo, man_repo.status())
+
+def _report_parser():
+  """
+  Returns an OptionParser for the commands that report on every project.
+  """
+  parser = _command_parser()
+  parser.add_option("--format", type="choice", dest="format",
+                    choices=["text", "jsonl"], default="text",
+                    help="text for people, or jsonl for one JSON record " +
+                    "per project, printed as each project finishes")
+  parser.add_option("-j", "--jobs", type="int", dest="jobs", default=None,
+                    help="check up to JOBS projects at once (one per " +
+                    "core by default)")
+  return parser
+
+def _emit_jsonl(projects, options, record_for_project):
+  """
+  Computes record_for_project(name, project) for every project, on up to
+  -j N threads, and prints each record as a line of JSON as soon as it is
+  ready. A project that raised gets a record with just its error. Returns
+  the finished jobs.
+  """
+  def emit(job):
+    if job.failed:
+      record = {"project": job.name, "error": str(job.error)}
+    else:
+      record = job.result
+    sys.stdout.write(simplejson.dumps(record) + "\n")
+    sys.stdout.flush()
+
+  queue = WorkQueue(_num_jobs(options), on_done=emit)
+  for (name, project) in projects:
+    queue.add(name, record_for_project, name, project)
+  queue.run()
+  return queue.jobs
+
+def _dirty_record(name, project, st=None):
+  if st is None:
+    st = repo_for_project(project).dirty_status()
+  return {"project": name,
+          "dir": project.dir,
+          "dirty": st.dirty,
+          "staged": st.staged,
+          "unstaged": st.unstaged}
+
+def _status_record(name, project, st=None, use_cat_file=False):
+  """
+  Returns a dict describing the project's checked out branch and HEAD,
+  how its tracking branch compares with the remote branch, and whether
+  it is dirty. ahead and behind are None if either branch is missing.
+  """
+  repo = repo_for_project(project, use_cat_file=use_cat_file)
+  if st is None:
+    st = repo.status()
+  tracking_branch = project.tracking_branch
+  remote_ref = project.remote_refspec
+  (has_tracking, has_remote, ahead, behind) = compare_tracking(
+    repo, tracking_branch, remote_ref, st)
+
+  return {"project": name,
+          "dir": project.dir,
+          "head": st.head,
+          "branch": st.branch,
+          "tracking_branch": tracking_branch,
+          "remote_branch": remote_ref,
+          "has_tracking_branch": has_tracking,
+          "has_remote_branch": has_remote,
+          "ahead": ahead,
+          "behind": behind,
+          "dirty": st.dirty,
+          "staged": st.staged,
+          "unstaged": st.unstaged,
+          "untracked": st.untracked}
+
+def _manifest_repo_status(repo, st):
+  if st.branch:
+    repo_status(repo, st.branch, "origin/" + st.branch, indent=2, st=st)
+  else:
+    print "  HEAD is detached."
+  check_dirty_repo(repo, indent=2, st=st)
 
 
 def get_manifest_repo():
@@ -288,31 +1094,183 @@ def dump_refs(args):
   """
   Output a list of all repositories along with their
   checked out branches and their hashes.
+
+  With --format=jsonl, prints the same records as status --format=jsonl.
   """
+  (options, args) = _report_parser().parse_args(args)
   man = load_manifest()
+  projects = selected_projects(man, options)
+  statuses = daemon_statuses([name for (name, project) in projects])
+  if options.format == "jsonl":
+    jobs = _emit_jsonl(projects, options,
+                       lambda name, project: _status_record(
+                         name, project, statuses.get(name), use_cat_file=True))
+    return [job for job in jobs if job.failed] and 1 or 0
   first = True
-  for (name, project) in man.projects.iteritems():
+  for (name, project) in projects:
     if not first: print
     first = False
     print "Project %s:" % name
 
-    repo = GitRepo(workdir_for_project(project))
-    print "  HEAD: %s" % repo.rev_parse("HEAD")
-    print "  Symbolic: %s" % repo.current_branch()
-    project_status(project, indent=2)
+    repo = repo_for_project(project, use_cat_file=True)
+    st = statuses.get(name) or repo.status()
+    print "  HEAD: %s" % st.head
+    print "  Symbolic: %s" % st.branch
+    repo_status(repo, project.tracking_branch, project.remote_refspec,
+                indent=2, st=st)
 
   repo = get_manifest_repo()
   if repo:
+    st = repo.status()
     print
     print "Manifest repo:"
-    print "  HEAD: %s" % repo.rev_parse("HEAD")
-    print "  Symbolic: %s" % repo.current_branch()
-    repo_status(repo,
-                repo.current_branch(),
-                "origin/" + repo.current_branch(),
-                indent=2)
-    check_dirty_repo(repo, indent=2)
-  
+    print "  HEAD: %s" % st.head
+    print "  Symbolic: %s" % st.branch
+    _manifest_repo_status(repo, st)
+
+
+def snapshot(args):
+  """Writes a manifest pinning every project to its checked out commit
+
+  usage: crepo snapshot FILE
+
+  The snapshot is an ordinary manifest whose projects each also have a
+  "revision". Pass it to "crepo sync --to FILE" to return to it, or select
+  the projects that have moved since with -s changed-since:FILE."""
+  (options, args) = _command_parser().parse_args(args)
+  if len(args) != 1:
+    usage()
+  man = load_manifest()
+  data = man.data_for_json()
+  projects = {}
+  for (name, project) in selected_projects(man, options):
+    projects[name] = data["projects"][name]
+    projects[name]["revision"] = _head_sha(project)
+  data["projects"] = projects
+
+  write_atomically(args[0],
+                   lambda f: simplejson.dump(data, f, indent=2,
+                                             sort_keys=True))
+  print >>sys.stderr, "Pinned %d projects in %s" % (len(projects), args[0])
+
+def _head_sha(project):
+  sha = _current_revision(project)
+  if sha:
+    return sha
+  return repo_for_project(project).rev_parse("HEAD")
+
+def sync(args):
+  """Moves every project to the commit pinned in a snapshot
+
+  usage: crepo sync --to SNAPSHOT [-j N] [--reset] [-f]
+
+  Checked out commits are compared with the snapshot without running git,
+  and only the projects that differ are touched: each is fetched if it
+  lacks the pinned commit, then has it checked out as a detached HEAD.
+  Pass --reset to hard-reset the current branch to it instead. Dirty
+  projects are not touched unless -f is given."""
+  parser = _remote_parser()
+  parser.add_option("--to", dest="snapshot", metavar="SNAPSHOT",
+                    help="the snapshot manifest to sync to")
+  parser.add_option("--reset", action="store_true", dest="reset",
+                    default=False,
+                    help="hard-reset the checked out branch instead of " +
+                    "detaching HEAD")
+  parser.add_option("-f", "--force", action="store_true", dest="force",
+                    default=False,
+                    help="sync dirty projects too, discarding their changes")
+  (options, args) = parser.parse_args(args)
+  if not options.snapshot or args:
+    usage()
+  man = load_manifest()
+  pinned = manifest.load_snapshot(options.snapshot)
+
+  projects = selected_projects(man, options)
+  to_sync = []
+  for (name, project) in projects:
+    if not pinned.get(name):
+      logging.warn("Project %s is not pinned in %s; skipping." %
+                   (name, options.snapshot))
+    elif _current_revision(project) != pinned[name]:
+      to_sync.append((name, project))
+  print >>sys.stderr, "%d of %d projects need syncing." % (
+    len(to_sync), len(projects))
+
+  num_jobs = _num_jobs(options)
+  preconnect(man, to_sync)
+  queue = WorkQueue(num_jobs, slots=_host_slots(man, options))
+  for (name, project) in to_sync:
+    job = queue.add(name, sync_project, man, name, project, pinned[name],
+                    options.reset, options.force)
+    job.hosts = project_hosts(man, name, project)
+  queue.run()
+  return queue.report()
+
+def sync_project(man, name, project, sha, reset=False, force=False):
+  """Fetches the commit sha into a project if needed and checks it out."""
+  repo = repo_for_project(project, use_cat_file=True)
+  if repo.rev_parse("HEAD") == sha:
+    return
+  if not _has_commit(repo, sha):
+    print >>sys.stderr, "Fetching %s to find %s" % (name, sha[:12])
+    remote_names = project.remotes.keys()
+    mirrors = mirror_paths(man, name, project, remote_names,
+                           refresh_mirrors(man, [(name, project)]))
+    for cmdv in _fetch_commands([], project, repo, remote_names,
+                                mirrors=mirrors):
+      repo.command(cmdv)
+    if not _has_commit(repo, sha):
+      # The commit may no longer be at the tip of a branch, which a shallow
+      # clone wouldn't have fetched; ask for it by name
+      repo.command(["fetch"] + fetch_options(project, repo) +
+                   [project.from_remote, sha])
+    if not _has_commit(repo, sha):
+      raise Exception("Commit %s is not in any remote of %s" % (sha, name))
+
+  if repo.dirty_status().dirty and not force:
+    raise Exception("Project %s is dirty; not syncing it." % name)
+  ensure_sparse_checkout(repo, project)
+  print >>sys.stderr, "Syncing project %s to %s" % (name, sha[:12])
+  if reset:
+    repo.check_command(["reset", "-q", "--hard", sha])
+  else:
+    repo.check_command(["checkout", "-q", "--detach"] +
+                       (force and ["-f"] or []) + [sha])
+
+def _has_commit(repo, sha):
+  info = repo.object_info(sha)
+  return info is not None and info[1] == "commit"
+
+
+DAEMON_SOCKET = "daemon.sock"
+
+def daemon(args):
+  """Runs a daemon that keeps every project's status in memory
+
+  status, check-dirty and dump-refs ask the daemon, if one is running in
+  this workspace, instead of running git status in every project. The
+  daemon watches each project with inotify and only recomputes the
+  status of projects that changed. Run "crepo daemon stop" to stop it."""
+  socket_path = state_path(DAEMON_SOCKET)
+  if args == ["stop"]:
+    if workspace_daemon.query(socket_path, {"command": "stop"}) is None:
+      print >>sys.stderr, "No daemon is running."
+      return 1
+    return 0
+  if args:
+    usage()
+  d = workspace_daemon.WorkspaceDaemon(load_manifest, workdir_for_project,
+                                       socket_path)
+  print >>sys.stderr, "Serving project status on %s" % socket_path
+  d.serve_forever()
+  return 0
+
+def daemon_statuses(names=None):
+  """
+  Returns a dict mapping project name to RepoStatus from the workspace
+  daemon, or an empty dict if no daemon is running.
+  """
+  return workspace_daemon.query_statuses(state_path(DAEMON_SOCKET), names)
 
 
 COMMANDS = {
@@ -326,12 +1284,21 @@ COMMANDS = {
   'status': status,
   'check-dirty': check_dirty,
   'setup-remotes': ensure_remotes,
-  'dump-refs': dump_refs
+  'setup-perf': setup_perf,
+  'dump-refs': dump_refs,
+  'snapshot': snapshot,
+  'sync': sync,
+  'daemon': daemon
   }
 
 def usage():
   print >>sys.stderr, "you screwed up. here are the commands:"
   print >>sys.stderr
+  print >>sys.stderr, "usage: crepo [--profile] [--trace-file=PATH] [--mirror-cache=DIR] command [args]"
+  print >>sys.stderr
+  print >>sys.stderr, "Every command takes -s SELECTOR to act on only some projects:"
+  print >>sys.stderr, "a project name or glob, group:GROUP, dir:GLOB or changed-since:SNAPSHOT."
+  print >>sys.stderr
 
   max_comlen = 0
   out = []
@@ -357,12 +1324,78 @@ def usage():
     print >>sys.stderr, "  %s   %s" % (command, "\n".join(output_docs))
   sys.exit(1)
 
+def _parse_global_args(args):
+  """
+  Handles the options that may come before the command name and returns
+  the remaining arguments:
+
+    --profile          print where the time went in git at exit
+    --trace-file=PATH  append a JSON record for every git process to PATH
+    --mirror-cache=DIR share bare mirrors of every remote in DIR between
+                       workspaces (default: $CREPO_MIRROR_CACHE)
+  """
+  global _mirror_cache
+  _mirror_cache = mirror_cache.from_environment()
+  while args and args[0].startswith("--"):
+    opt = args.pop(0)
+    if opt == "--profile":
+      profile = trace.Profile()
+      trace.AddSpanSink(profile)
+      atexit.register(profile.Summary)
+    elif opt.startswith("--trace-file="):
+      trace.AddSpanSink(trace.JsonLinesSink(opt[len("--trace-file="):]))
+    elif opt == "--trace-file" and args:
+      trace.AddSpanSink(trace.JsonLinesSink(args.pop(0)))
+    elif opt.startswith("--mirror-cache="):
+      _mirror_cache = mirror_cache.MirrorCache(opt[len("--mirror-cache="):])
+    elif opt == "--mirror-cache" and args:
+      _mirror_cache = mirror_cache.MirrorCache(args.pop(0))
+    else:
+      usage()
+  return args
+
 def main():
-  args = sys.argv[1:]
+  GitRepo.tracking_cache = TrackingCache(state_path("ahead-behind.json"))
+  atexit.register(GitRepo.tracking_cache.save)
+  atexit.register(git_command.close_ssh_masters)
+
+  args = _parse_global_args(sys.argv[1:])
   if len(args) == 0 or args[0] not in COMMANDS:
     usage()
   command = COMMANDS[args[0]]
   sys.exit(command.__call__(args[1:]))
 
+
+def test_fetch_filtered_project():
+  import shutil, tempfile
+  root = tempfile.mkdtemp()
+  cwd = os.getcwd()
+  try:
+    src = os.path.join(root, "pig.git")
+    GitCommand(None, ["init", "-q", src]).Wait()
+    GitCommand(None, ["-c", "user.name=t", "-c", "user.email=t@t", "commit",
+                      "-q", "--allow-empty", "-m", "one"], cwd=src).Wait()
+    GitCommand(None, ["config", "uploadpack.allowFilter", "true"],
+               cwd=src).Wait()
+    man = manifest.Manifest.from_dict({
+      "remotes": {"origin": {"fetch": "file://%s/%%s.git" % root},
+                  "up": {"fetch": "file://%s/%%s.git" % root}},
+      "default-filter": "blob:none",
+      "projects": {"pig": {"remotes": ["origin", "up"]}}})
+    project = man.projects["pig"]
+    os.chdir(root)
+    clone_project(man, "pig", project, quiet=True)
+    repo = repo_for_project(project)
+    ensure_project_remotes(man, repo, "pig", project)
+    assert repo.config().get("remote.origin.partialclonefilter") == "blob:none"
+    # Both remotes are fetched by one fetch --multiple, which git refuses
+    # with --filter
+    cmdvs = _fetch_commands([], project, repo, ["origin", "up"])
+    assert len(cmdvs) == 1 and "--multiple" in cmdvs[0]
+    assert repo.command(cmdvs[0] + ["-q"]) == 0
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(root)
+
 if __name__ == "__main__":
   main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python2.5
+# (c) Copyright 2009 Cloudera, Inc.
+
+import atexit
+import os
+import threading
+from git_command import GitCommand
+from error import GitError
+
+BATCH_CHECK = '--batch-check'
+BATCH = '--batch'
+
+DEFAULT_POOL_SIZE = 16
+
+class CatFile(object):
+  """
+  A long-lived git cat-file --batch-check (or --batch) coprocess for one
+  repository. Each lookup is a single round-trip over its pipes. The
+  coprocess is (re)started on demand, so a CatFile that was closed, eg
+  by its pool evicting it, still works.
+  """
+  def __init__(self, path, mode=BATCH_CHECK, project_name=None):
+    self.path = path
+    self.mode = mode
+    self.project_name = project_name
+    self.lock = threading.Lock()
+    self.proc = None
+    self._start()
+
+  def _start(self):
+    self.proc = GitCommand(project=None,
+                           cwd=self.path,
+                           cmdv=['cat-file', self.mode],
+                           project_name=self.project_name,
+                           provide_stdin=True,
+                           capture_stdout=True)
+
+  @property
+  def alive(self):
+    return self.proc is not None and self.proc.process.poll() is None
+
+  def _request(self, rev):
+    if '\n' in rev:
+      raise ValueError("revision may not contain a newline: %r" % rev)
+    if not self.alive:
+      self._stop()
+      self._start()
+    p = self.proc.process
+    try:
+      p.stdin.write(rev + '\n')
+      p.stdin.flush()
+      header = p.stdout.readline()
+    except (IOError, ValueError), e:
+      raise GitError('cat-file %s: %s' % (self.mode, e))
+    if not header:
+      raise GitError('cat-file %s: coprocess exited' % self.mode)
+    # "<sha> <type> <size>", or "<rev> missing" where rev, echoed back,
+    # may itself contain spaces
+    fields = header.rstrip('\n').rsplit(' ', 2)
+    if fields[-1] in ('missing', 'ambiguous') or len(fields) != 3:
+      return None
+    return (fields[0], fields[1], int(fields[2]))
+
+  def info(self, rev):
+    """
+    Returns (sha, type, size) for the object rev names, or None if it
+    does not exist.
+    """
+    self.lock.acquire()
+    try:
+      info = self._request(rev)
+      if info and self.mode == BATCH:
+        # Skip the contents and the trailing newline
+        self.proc.process.stdout.read(info[2] + 1)
+      return info
+    finally:
+      self.lock.release()
+
+  def read(self, rev):
+    """
+    Returns (sha, type, data) for the object rev names, or None if it
+    does not exist. Only valid in --batch mode.
+    """
+    assert self.mode == BATCH
+    self.lock.acquire()
+    try:
+      info = self._request(rev)
+      if info is None:
+        return None
+      data = self.proc.process.stdout.read(info[2] + 1)[:-1]
+      return (info[0], info[1], data)
+    finally:
+      self.lock.release()
+
+  def _stop(self):
+    if self.proc is not None:
+      self.proc.Wait()
+      self.proc = None
+
+  def close(self):
+    """Stops the coprocess. The next lookup starts a new one."""
+    self.lock.acquire()
+    try:
+      self._stop()
+    finally:
+      self.lock.release()
+
+
+class CatFilePool(object):
+  """
+  Keeps at most max_size CatFile coprocesses alive across all
+  repositories, closing the least recently used one when full. A closed
+  CatFile restarts itself on its next lookup, so callers still holding
+  one are unaffected.
+  """
+  def __init__(self, max_size=DEFAULT_POOL_SIZE):
+    self.max_size = max_size
+    self.lock = threading.Lock()
+    # (path, mode) -> CatFile, and the keys from least to most recently used
+    self.procs = {}
+    self.lru = []
+
+  def get(self, path, mode=BATCH_CHECK, project_name=None):
+    key = (os.path.realpath(path), mode)
+    evicted = []
+    self.lock.acquire()
+    try:
+      proc = self.procs.get(key)
+      if proc is not None and not proc.alive:
+        del self.procs[key]
+        self.lru.remove(key)
+        proc = None
+      if proc is None:
+        proc = CatFile(path, mode, project_name)
+        self.procs[key] = proc
+      else:
+        self.lru.remove(key)
+      self.lru.append(key)
+      while len(self.lru) > self.max_size:
+        evicted.append(self.procs.pop(self.lru.pop(0)))
+    finally:
+      self.lock.release()
+
+    for old in evicted:
+      old.close()
+    return proc
+
+  def close_all(self):
+    self.lock.acquire()
+    try:
+      procs = self.procs.values()
+      self.procs = {}
+      self.lru = []
+    finally:
+      self.lock.release()
+    for proc in procs:
+      proc.close()
+
+pool = CatFilePool()
+atexit.register(pool.close_all)
+
+
+def test_cat_file_pool():
+  import shutil, tempfile
+  root = tempfile.mkdtemp()
+  try:
+    paths = []
+    for name in ('alpha', 'beta'):
+      path = os.path.join(root, name)
+      GitCommand(None, ['init', '-q', path]).Wait()
+      GitCommand(None, ['-c', 'user.name=t', '-c', 'user.email=t@t',
+                        'commit', '-q', '--allow-empty', '-m', name],
+                 cwd=path).Wait()
+      paths.append(path)
+    pool = CatFilePool(max_size=1)
+    alpha = pool.get(paths[0])
+    assert alpha.info('HEAD')[1] == 'commit'
+    beta = pool.get(paths[1])
+    # alpha was evicted, but still answers by restarting itself
+    assert not alpha.alive
+    assert alpha.info('HEAD')[1] == 'commit'
+    assert alpha.info('no-such-ref') is None
+    # A missing name that happens to have three words
+    assert alpha.info('HEAD:a b') is None
+    assert alpha.info('HEAD:a b c') is None
+    assert beta.info('HEAD')[1] == 'commit'
+    assert pool.get(paths[1]) is beta
+
+    blob = CatFile(paths[0], BATCH)
+    assert blob.read('HEAD')[1] == 'commit'
+    blob.close()
+    assert blob.read('HEAD^{tree}')[1] == 'tree'
+    blob.close()
+    pool.close_all()
+    alpha.close()
+  finally:
+    shutil.rmtree(root)
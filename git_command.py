@@ -15,10 +15,14 @@
 
 import os
 import sys
+import errno
+import select
 import subprocess
 import tempfile
+import threading
 from error import GitError
-from trace import REPO_TRACE, IsTrace, Trace
+import time
+from trace import REPO_TRACE, IsTrace, Trace, IsSpanTrace, RecordSpan
 
 GIT = 'git'
 MIN_GIT_VERSION = (1, 5, 4)
@@ -47,10 +51,100 @@ def _ssh_proxy():
   global _ssh_proxy_path
   if _ssh_proxy_path is None:
     _ssh_proxy_path = os.path.join(
-      os.path.dirname(__file__),
+      os.path.dirname(os.path.abspath(__file__)),
       'git_ssh')
   return _ssh_proxy_path
 
+# (target, port) -> True if a ControlMaster is running for it
+_ssh_masters = {}
+_ssh_lock = threading.Lock()
+# (target, port) -> lock held while its master is being opened
+_ssh_target_locks = {}
+
+# Seconds to wait for a host to accept a shared connection
+SSH_CONNECT_TIMEOUT = 10
+
+def _ssh_control_args(port):
+  args = ['-o', 'ControlPath %s' % _ssh_sock()]
+  if port:
+    args.extend(['-p', str(port)])
+  return args
+
+def open_ssh_master(target, port=None):
+  """
+  Starts a shared ssh connection to target (host or user@host) that later
+  git commands reuse through git_ssh, and returns True if one is running.
+  Once any master is open, every GitCommand runs git with GIT_SSH set to
+  git_ssh; hosts without a master are simply connected to directly. Never
+  prompts, and gives up on hosts that don't answer within
+  SSH_CONNECT_TIMEOUT seconds. Masters for different targets may be
+  opened from several threads at once.
+  """
+  key = (target, port)
+  _ssh_lock.acquire()
+  try:
+    if key not in _ssh_target_locks:
+      _ssh_target_locks[key] = threading.Lock()
+    lock = _ssh_target_locks[key]
+  finally:
+    _ssh_lock.release()
+
+  lock.acquire()
+  try:
+    if key not in _ssh_masters:
+      # -f only returns once the connection is authenticated
+      command = (['ssh', '-M', '-N', '-f',
+                  '-o', 'BatchMode yes',
+                  '-o', 'ConnectTimeout %d' % SSH_CONNECT_TIMEOUT] +
+                 _ssh_control_args(port) + [target])
+      devnull = open(os.devnull)
+      try:
+        rc = subprocess.call(command, stdin=devnull)
+      except OSError:
+        rc = -1
+      devnull.close()
+      _ssh_lock.acquire()
+      try:
+        _ssh_masters[key] = rc == 0
+      finally:
+        _ssh_lock.release()
+    return _ssh_masters[key]
+  finally:
+    lock.release()
+
+def close_ssh_masters():
+  """Stops every master opened by open_ssh_master."""
+  _ssh_lock.acquire()
+  try:
+    devnull = open(os.devnull, 'w')
+    for ((target, port), running) in _ssh_masters.items():
+      if running:
+        subprocess.call(['ssh', '-O', 'exit'] + _ssh_control_args(port) +
+                        [target], stdout=devnull, stderr=devnull)
+    devnull.close()
+    _ssh_masters.clear()
+    sock = _ssh_sock(create=False)
+    if sock:
+      try:
+        os.rmdir(os.path.dirname(sock))
+      except OSError:
+        pass
+  finally:
+    _ssh_lock.release()
+
+def _subcommand(cmdv):
+  """Returns the git subcommand in cmdv, skipping global options."""
+  i = 0
+  while i < len(cmdv):
+    arg = cmdv[i]
+    if arg in ('-c', '-C'):
+      i += 2
+    elif arg.startswith('-'):
+      i += 1
+    else:
+      return arg
+  return ''
+
 
 class _GitCall(object):
   def version(self):
@@ -79,7 +173,8 @@ class GitCommand(object):
                disable_editor = False,
                ssh_proxy = False,
                cwd = None,
-               gitdir = None):
+               gitdir = None,
+               project_name = None):
     env = dict(os.environ)
 
     for e in [REPO_TRACE,
@@ -94,9 +189,11 @@ class GitCommand(object):
 
     if disable_editor:
       env['GIT_EDITOR'] = ':'
-    if ssh_proxy:
+    if ssh_proxy or [m for m in _ssh_masters.values() if m]:
       env['REPO_SSH_SOCK'] = _ssh_sock()
       env['GIT_SSH'] = _ssh_proxy()
+      # Otherwise git assumes a wrapper with this name can't take -p
+      env['GIT_SSH_VARIANT'] = 'ssh'
 
     if project:
       if not cwd:
@@ -154,6 +251,16 @@ class GitCommand(object):
         dbg += ' 2>|'
       Trace('%s', dbg)
 
+    self._span = None
+    if IsSpanTrace():
+      self._span = {'project': project_name,
+                    'argv': command,
+                    'cwd': cwd,
+                    'command': _subcommand(cmdv),
+                    'start': time.time()}
+    self.stdout_bytes = 0
+    self.stderr_bytes = 0
+
     try:
       p = subprocess.Popen(command,
                            cwd = cwd,
@@ -166,24 +273,144 @@ class GitCommand(object):
 
     self.process = p
     self.stdin = p.stdin
+    self._drained = False
 
-  def Wait(self):
+  def Wait(self, max_output=None):
+    """
+    Waits for the process to exit and returns its exit code. Captured
+    stdout and stderr are read concurrently and kept in self.stdout and
+    self.stderr; if max_output is given, only that many bytes of each are
+    kept and the rest is discarded.
+    """
     p = self.process
 
     if p.stdin:
       p.stdin.close()
       self.stdin = None
 
-    if p.stdout:
-      self.stdout = p.stdout.read()
-      p.stdout.close()
-    else:
-      p.stdout = None
+    if not self._drained:
+      out = []
+      kept = 0
+      for chunk in self.Stream(max_stderr=max_output):
+        if max_output is not None:
+          chunk = chunk[:max(0, max_output - kept)]
+        kept += len(chunk)
+        if chunk:
+          out.append(chunk)
+      if p.stdout:
+        self.stdout = ''.join(out)
+
+    rc = self.process.wait()
+    self.RecordExit(rc)
+    return rc
+
+  def RecordExit(self, rc):
+    """
+    Finishes the trace span for this process. Callers that read the
+    pipes and reap the process themselves should call this, and count
+    what they read in stdout_bytes and stderr_bytes.
+    """
+    span = self._span
+    if span is None:
+      return
+    self._span = None
+    span['duration'] = time.time() - span['start']
+    span['exit_code'] = rc
+    span['stdout_bytes'] = self.stdout_bytes
+    span['stderr_bytes'] = self.stderr_bytes
+    RecordSpan(span)
 
+  def Stream(self, chunk_size=65536, max_stderr=None):
+    """
+    Yields captured stdout in chunks as the process produces it, while
+    draining captured stderr at the same time so that neither pipe can
+    fill up and block the child. stderr is kept in self.stderr, capped at
+    max_stderr bytes if given. Call Wait() afterwards for the exit code.
+    """
+    p = self.process
+    self._drained = True
+    if p.stdin:
+      p.stdin.close()
+      self.stdin = None
+
+    files = {}
+    stdout_fd = None
+    if p.stdout:
+      stdout_fd = p.stdout.fileno()
+      files[stdout_fd] = p.stdout
     if p.stderr:
-      self.stderr = p.stderr.read()
-      p.stderr.close()
-    else:
-      p.stderr = None
+      files[p.stderr.fileno()] = p.stderr
+    errs = []
+    err_len = 0
+
+    try:
+      while files:
+        try:
+          (readable, _, _) = select.select(files.keys(), [], [])
+        except select.error, e:
+          if e[0] == errno.EINTR:
+            continue
+          raise
+        for fd in readable:
+          data = os.read(fd, chunk_size)
+          if not data:
+            files.pop(fd).close()
+          elif fd == stdout_fd:
+            self.stdout_bytes += len(data)
+            yield data
+          else:
+            self.stderr_bytes += len(data)
+            if max_stderr is not None:
+              data = data[:max(0, max_stderr - err_len)]
+            errs.append(data)
+            err_len += len(data)
+    finally:
+      for f in files.values():
+        f.close()
+      if p.stderr:
+        self.stderr = ''.join(errs)
+
+  def Lines(self, max_stderr=None):
+    """
+    Like Stream(), but yields stdout one line at a time, without the
+    trailing newline.
+    """
+    partial = ''
+    for chunk in self.Stream(max_stderr=max_stderr):
+      lines = (partial + chunk).split('\n')
+      partial = lines.pop()
+      for line in lines:
+        yield line
+    if partial:
+      yield partial
+
+
+def test_stream_does_not_deadlock():
+  # Fill the stderr pipe well past its buffer before writing any stdout
+  p = GitCommand(None, ['-c', 'alias.spew=!head -c 200000 /dev/zero >&2; echo out',
+                        'spew'],
+                 capture_stdout=True, capture_stderr=True)
+  assert p.Wait(max_output=1000) == 0
+  assert p.stdout == 'out\n'
+  assert len(p.stderr) == 1000
+
+def test_lines():
+  # Interleaved stdout and stderr, with stderr well past a pipe buffer
+  script = ('!for i in 1 2 3; do echo line$i; head -c 30000 /dev/zero >&2; ' +
+            'done; printf tail')
+  p = GitCommand(None, ['-c', 'alias.mix=' + script, 'mix'],
+                 capture_stdout=True, capture_stderr=True)
+  assert list(p.Lines()) == ['line1', 'line2', 'line3', 'tail']
+  assert len(p.stderr) == 90000
+  assert p.Wait() == 0
 
-    return self.process.wait()
+  # Stopping early closes the pipes, and the child is still reaped
+  script = '!yes line; echo done >&2'
+  p = GitCommand(None, ['-c', 'alias.many=' + script, 'many'],
+                 capture_stdout=True, capture_stderr=True)
+  lines = p.Lines()
+  assert [lines.next() for i in xrange(1000)] == ['line'] * 1000
+  lines.close()
+  # How the child exits on the closed pipe depends on its SIGPIPE handling
+  assert p.Wait() is not None
+  assert p.stdout_bytes >= 5000
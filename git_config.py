@@ -0,0 +1,273 @@
+#!/usr/bin/env python2.5
+# (c) Copyright 2009 Cloudera, Inc.
+
+import os
+import re
+from error import GitError
+
+_SECTION_RE = re.compile(r'^\[\s*([A-Za-z0-9.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+_KEY_RE = re.compile(r'^([A-Za-z][A-Za-z0-9-]*)\s*(.*)$', re.S)
+_ESCAPES = {'n': '\n', 't': '\t', 'b': '\b', '\\': '\\', '"': '"'}
+
+class GitConfig(object):
+  """
+  A git config file, read and written in-process. Edits are made to the
+  file's lines in memory, keeping its comments and layout, and save()
+  writes them all at once under the same config.lock git uses. include
+  and includeIf directives are not followed.
+  """
+  def __init__(self, path):
+    self.path = path
+    self.dirty = False
+    try:
+      f = open(path)
+    except IOError:
+      self.text = None
+      self.lines = []
+    else:
+      try:
+        self.text = f.read()
+      finally:
+        f.close()
+      self.lines = _logical_lines(self.text)
+    self._parse()
+
+  def _parse(self):
+    # (line index, section, subsection) for every section header, and
+    # (line index, section, subsection, name, value) for every variable
+    self.sections = []
+    self.entries = []
+    section = subsection = None
+    for (i, raw) in enumerate(self.lines):
+      line = raw.strip()
+      if not line or line[0] in "#;":
+        continue
+      if line.startswith("["):
+        m = _SECTION_RE.match(line)
+        if not m:
+          raise GitError("bad config section header in %s: %s" %
+                         (self.path, line))
+        section = m.group(1)
+        subsection = m.group(2)
+        if subsection is not None:
+          subsection = re.sub(r'\\(.)', r'\1', subsection)
+        elif "." in section:
+          # Deprecated [section.subsection] syntax
+          (section, subsection) = section.split(".", 1)
+          subsection = subsection.lower()
+        section = section.lower()
+        self.sections.append((i, section, subsection))
+        continue
+      m = _KEY_RE.match(line)
+      if not m or section is None:
+        raise GitError("bad config line in %s: %s" % (self.path, line))
+      self.entries.append((i, section, subsection, m.group(1).lower(),
+                           _parse_value(m.group(2))))
+
+  def _matching(self, key):
+    (section, subsection, name) = _split_key(key)
+    return [e for e in self.entries
+            if e[1:4] == (section, subsection, name)]
+
+  def get(self, key):
+    """Returns the last value of key, or None if it is not set."""
+    matches = self._matching(key)
+    if not matches:
+      return None
+    return matches[-1][4]
+
+  def get_all(self, key):
+    return [e[4] for e in self._matching(key)]
+
+  def set(self, key, value):
+    """Sets key to value, replacing its last value if it has one."""
+    matches = self._matching(key)
+    if matches:
+      if matches[-1][4] == value:
+        return
+      self.lines[matches[-1][0]] = _format_entry(key, value)
+      self._parse()
+      self.dirty = True
+    else:
+      self.add(key, value)
+
+  def add(self, key, value):
+    """Adds value to key, keeping any values it already has."""
+    (section, subsection, name) = _split_key(key)
+    line = _format_entry(key, value)
+    headers = [s[0] for s in self.sections if s[1:] == (section, subsection)]
+    if headers:
+      # Add it after the last variable of the last such section
+      i = headers[-1]
+      for e in self.entries:
+        if e[0] > i and e[1:3] == (section, subsection):
+          i = e[0]
+        elif e[0] > i:
+          break
+      self.lines.insert(i + 1, line)
+    else:
+      if self.lines and not self.lines[-1].endswith("\n"):
+        self.lines[-1] += "\n"
+      if subsection is None:
+        self.lines.append("[%s]\n" % section)
+      else:
+        self.lines.append('[%s "%s"]\n' % (
+          section, subsection.replace("\\", "\\\\").replace('"', '\\"')))
+      self.lines.append(line)
+    self._parse()
+    self.dirty = True
+
+  def save(self):
+    """
+    Writes the changes, if there are any. Like git, this takes
+    config.lock with O_EXCL, writes the new contents there and renames it
+    over the config. Raises GitError if the lock is held or if the file
+    changed since it was read.
+    """
+    if not self.dirty:
+      return
+    lock_path = self.path + ".lock"
+    try:
+      fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+    except OSError, e:
+      raise GitError("could not lock %s: %s" % (self.path, e))
+    try:
+      current = None
+      if os.path.exists(self.path):
+        current = open(self.path).read()
+      if current != self.text:
+        raise GitError("%s changed while it was being edited" % self.path)
+      text = "".join(self.lines)
+      f = os.fdopen(fd, "w")
+      fd = None
+      try:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+      finally:
+        f.close()
+      os.rename(lock_path, self.path)
+    except:
+      if fd is not None:
+        os.close(fd)
+      if os.path.exists(lock_path):
+        os.unlink(lock_path)
+      raise
+    self.text = text
+    self.dirty = False
+
+
+def _split_key(key):
+  """Splits section.subsection.name into its parts, normalizing case."""
+  parts = key.split(".")
+  if len(parts) < 2:
+    raise GitError("bad config key %s" % key)
+  subsection = None
+  if len(parts) > 2:
+    subsection = ".".join(parts[1:-1])
+  return (parts[0].lower(), subsection, parts[-1].lower())
+
+def _logical_lines(text):
+  """Splits text into lines, joining lines continued with a backslash."""
+  lines = []
+  pending = ""
+  for line in text.splitlines(True):
+    pending += line
+    stripped = line.rstrip("\r\n")
+    trailing = len(stripped) - len(stripped.rstrip("\\"))
+    if trailing % 2 == 1 and line != stripped:
+      continue
+    lines.append(pending)
+    pending = ""
+  if pending:
+    lines.append(pending)
+  return lines
+
+def _parse_value(rest):
+  """Parses what follows a variable name, eg '= "a b" # comment'."""
+  rest = rest.strip()
+  if not rest or rest[0] in "#;":
+    # A name on its own means true
+    return "true"
+  if rest[0] != "=":
+    raise GitError("bad config value %r" % rest)
+  value = []
+  # Unquoted trailing whitespace is dropped, so track where it starts
+  keep = 0
+  quoted = False
+  i = 1
+  while i < len(rest):
+    c = rest[i]
+    if c == "\\" and i + 1 < len(rest):
+      i += 1
+      c = rest[i]
+      if c in "\r\n":
+        i += 1
+        continue
+      if c not in _ESCAPES:
+        raise GitError("bad escape in config value %r" % rest)
+      value.append(_ESCAPES[c])
+      keep = len(value)
+    elif c == '"':
+      quoted = not quoted
+      keep = len(value)
+    elif not quoted and c in "#;":
+      break
+    elif not quoted and c.isspace():
+      if value:
+        value.append(c)
+    else:
+      value.append(c)
+      keep = len(value)
+    i += 1
+  return "".join(value[:keep])
+
+def _format_entry(key, value):
+  name = key.split(".")[-1]
+  value = value.replace("\\", "\\\\").replace('"', '\\"')
+  value = value.replace("\n", "\\n").replace("\t", "\\t")
+  if (value != value.strip() or "#" in value or ";" in value):
+    value = '"%s"' % value
+  return "\t%s = %s\n" % (name, value)
+
+
+def test_git_config():
+  import tempfile, shutil
+  root = tempfile.mkdtemp()
+  try:
+    path = os.path.join(root, "config")
+    open(path, "w").write(
+      "[core]\n\tbare = false\n\tfilemode\n" +
+      "# a comment\n" +
+      '[remote "origin"]\n\turl = "/some path" ; trailing\n' +
+      "\tfetch = +refs/heads/*:refs/remotes/origin/*\n" +
+      "[branch.Master]\n\tremote = ori\\\ngin\n")
+    config = GitConfig(path)
+    assert config.get("core.bare") == "false"
+    assert config.get("core.fileMode") == "true"
+    assert config.get("remote.origin.url") == "/some path"
+    assert config.get("branch.master.remote") == "origin"
+    assert config.get("remote.upstream.url") is None
+
+    config.set("remote.origin.url", "git://example.com/a;b")
+    config.set("remote.upstream.url", "git://example.com/b")
+    config.add("remote.upstream.fetch", "+refs/heads/*:refs/remotes/upstream/*")
+    config.set("core.bare", "false")
+    config.save()
+    assert not os.path.exists(path + ".lock")
+
+    config = GitConfig(path)
+    assert config.get("remote.origin.url") == "git://example.com/a;b"
+    assert config.get("remote.upstream.fetch") == "+refs/heads/*:refs/remotes/upstream/*"
+    assert "# a comment\n" in config.lines
+    assert not config.dirty
+
+    open(path + ".lock", "w").close()
+    config.set("core.bare", "true")
+    try:
+      config.save()
+      assert False
+    except GitError:
+      pass
+  finally:
+    shutil.rmtree(root)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python2.5
+# (c) Copyright 2009 Cloudera, Inc.
+
+import os
+import sys
+import errno
+import select
+import time
+from work_queue import Job, HostSlots, report_failures
+
+# Output modes
+DIRECT = 'direct'   # children write straight to the terminal
+PREFIX = 'prefix'   # every line is prefixed with [project] as it arrives
+BUFFER = 'buffer'   # each project's output is printed whole when it finishes
+MODES = (DIRECT, PREFIX, BUFFER)
+
+# How many lines of each task's stderr to keep for callers to inspect
+STDERR_TAIL_LINES = 50
+
+class _Task(Job):
+  """A project's git commands, run one after the other."""
+  def __init__(self, name, repo, cmdvs):
+    Job.__init__(self, name, None)
+    self.repo = repo
+    self.cmdvs = list(cmdvs)
+    self.result = 0
+    self.proc = None
+    self.partial = {}
+    self.buffered = []
+    # The last lines the task wrote to stderr, except in DIRECT mode
+    # without keep_stderr
+    self.stderr_tail = []
+    self.started = None
+
+
+class GitMux(object):
+  """
+  Runs git commands for many projects from a single thread. Up to
+  max_running children are alive at once; their stdout and stderr are
+  multiplexed with select() and either prefixed line by line with the
+  project name or buffered per project, depending on mode. With slots (a
+  HostSlots), tasks also wait for room on the remote hosts they use.
+  In DIRECT mode stderr is left alone unless keep_stderr is set, in which
+  case it is read through a pipe and copied to err as it arrives, so
+  that each task's stderr_tail is kept as in the other modes.
+  """
+  def __init__(self, max_running=1, mode=PREFIX, out=None, err=None,
+               slots=None, keep_stderr=False):
+    assert mode in MODES
+    self.max_running = max(1, max_running)
+    self.mode = mode
+    self.keep_stderr = keep_stderr
+    self.out = out or sys.stdout
+    self.err = err or sys.stderr
+    self.slots = slots or HostSlots()
+    self.jobs = []
+
+  def add(self, name, repo, cmdvs, hosts=()):
+    """
+    Queues the list of git commands cmdvs to run in repo, talking to the
+    remote hosts in hosts.
+    """
+    task = _Task(name, repo, cmdvs)
+    task.hosts = tuple(hosts)
+    self.jobs.append(task)
+    return task
+
+  def run(self):
+    pending = list(self.jobs)
+    running = []
+    # fd -> (task, stream)
+    fds = {}
+
+    while pending or running:
+      while pending and len(running) < self.max_running:
+        task = self.slots.take_next(pending)
+        if task is None:
+          break
+        if self._start_next(task, fds):
+          running.append(task)
+        else:
+          self._finish(task)
+
+      if not fds:
+        # Only DIRECT children are left; there is nothing to multiplex,
+        # so just poll for the ones that have exited
+        exited = [task for task in running
+                  if task.proc.process.poll() is not None]
+        if not exited:
+          time.sleep(0.05)
+        for task in exited:
+          self._reap(task, fds)
+          if not self._start_next(task, fds):
+            running.remove(task)
+            self._finish(task)
+        continue
+
+      try:
+        (readable, _, _) = select.select(fds.keys(), [], [])
+      except select.error, e:
+        if e[0] == errno.EINTR:
+          continue
+        raise
+      exited = []
+      for fd in readable:
+        (task, stream) = fds[fd]
+        data = os.read(fd, 65536)
+        if data:
+          if stream is self.out:
+            task.proc.stdout_bytes += len(data)
+          else:
+            task.proc.stderr_bytes += len(data)
+          self._output(task, stream, data)
+          continue
+        del fds[fd]
+        self._output(task, stream, None)
+        p = task.proc.process
+        if not [f for f in (p.stdout, p.stderr)
+                if f and f.fileno() in fds]:
+          exited.append(task)
+
+      # Only start new children once we're done with this round of fds,
+      # since they may reuse the numbers of the ones just closed
+      for task in exited:
+        self._reap(task, fds)
+        if not self._start_next(task, fds):
+          running.remove(task)
+          self._finish(task)
+    return self.jobs
+
+  def _start_next(self, task, fds):
+    """Starts the task's next command, returning False if there is none."""
+    if not task.cmdvs:
+      return False
+    cmdv = task.cmdvs.pop(0)
+    if task.started is None:
+      task.started = time.time()
+    header = "In project: %s running %s" % (task.name, " ".join(cmdv))
+    if self.mode == DIRECT:
+      print >>self.err, header
+    elif self.mode == BUFFER:
+      task.buffered.append((self.err, header + "\n"))
+    capture = self.mode != DIRECT
+    try:
+      task.proc = task.repo.command_process(
+        cmdv,
+        capture_stdout=capture,
+        capture_stderr=capture or self.keep_stderr)
+    except Exception, e:
+      task.error = e
+      task.cmdvs = []
+      return False
+    p = task.proc.process
+    if p.stdout:
+      fds[p.stdout.fileno()] = (task, self.out)
+    if p.stderr:
+      fds[p.stderr.fileno()] = (task, self.err)
+    return True
+
+  def _reap(self, task, fds):
+    p = task.proc.process
+    for f in (p.stdout, p.stderr):
+      if f:
+        fds.pop(f.fileno(), None)
+        f.close()
+    rc = p.wait()
+    task.proc.RecordExit(rc)
+    if rc != 0:
+      task.result = rc
+    if self.mode == DIRECT:
+      print >>self.err
+
+  def _output(self, task, stream, data):
+    """Handles data read from a child; data is None at end of file."""
+    partial = task.partial.get(stream, "")
+    if data is None:
+      lines = partial and [partial] or []
+      task.partial[stream] = ""
+    else:
+      lines = (partial + data).split("\n")
+      task.partial[stream] = lines.pop()
+
+    if stream is self.err and lines:
+      task.stderr_tail.extend(lines)
+      del task.stderr_tail[:-STDERR_TAIL_LINES]
+
+    if self.mode == BUFFER:
+      if data:
+        task.buffered.append((stream, data))
+      return
+    if self.mode == DIRECT:
+      if data:
+        stream.write(data)
+        stream.flush()
+      return
+
+    if lines:
+      prefix = "[%s] " % task.name
+      stream.write("".join([prefix + line + "\n" for line in lines]))
+      stream.flush()
+
+  def _finish(self, task):
+    self.slots.release(task.hosts)
+    if task.started is not None:
+      task.duration = time.time() - task.started
+    if self.mode == BUFFER and task.buffered:
+      for (stream, data) in task.buffered:
+        stream.write(data)
+      for stream in (self.out, self.err):
+        stream.flush()
+      task.buffered = []
+
+  def report(self, out=sys.stderr):
+    return report_failures(self.jobs, out)
+
+
+def test_git_mux():
+  from StringIO import StringIO
+  from git_command import GitCommand
+  # A git alias that prints its first argument to stdout and stderr,
+  # sleeps a moment and exits with its second argument
+  say = ['-c', 'alias.say=!f() { echo "$1"; echo "e$1" >&2; sleep 0.2; ' +
+         'exit $2; }; f', 'say']
+  started = []
+  peak = [0]
+  class Repo(object):
+    def command_process(self, cmdv, **kwargs):
+      running = [p for p in started if p.process.poll() is None]
+      peak[0] = max(peak[0], len(running) + 1)
+      p = GitCommand(None, cmdv, **kwargs)
+      started.append(p)
+      return p
+
+  (out, err) = (StringIO(), StringIO())
+  mux = GitMux(2, PREFIX, out, err)
+  for (name, code) in [("a", "0"), ("b", "3"), ("c", "0"), ("d", "0")]:
+    mux.add(name, Repo(), [say + [name + "1", code], say + [name + "2", "0"]])
+  mux.run()
+  assert peak[0] == 2
+  lines = out.getvalue().splitlines()
+  assert sorted(lines) == ["[a] a1", "[a] a2", "[b] b1", "[b] b2",
+                           "[c] c1", "[c] c2", "[d] d1", "[d] d2"]
+  assert "[b] eb1" in err.getvalue().splitlines()
+  assert [task.stderr_tail for task in mux.jobs if task.name == "b"] == \
+         [["eb1", "eb2"]]
+  report = StringIO()
+  assert mux.report(report) == 1
+  assert "1 of 4 projects failed:" in report.getvalue()
+  assert "  b: exit code 3" in report.getvalue().splitlines()
+
+  # Buffered output comes out whole, one project after the other
+  (out, err) = (StringIO(), StringIO())
+  mux = GitMux(3, BUFFER, out, err)
+  for name in ("a", "b", "c"):
+    mux.add(name, Repo(), [say + [name + "1", "0"], say + [name + "2", "0"]])
+  mux.run()
+  lines = out.getvalue().splitlines()
+  assert sorted([lines[i:i + 2] for i in (0, 2, 4)]) == \
+         [["a1", "a2"], ["b1", "b2"], ["c1", "c2"]]
+  assert mux.report(StringIO()) == 0
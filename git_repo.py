@@ -2,11 +2,30 @@
 # (c) Copyright 2009 Cloudera, Inc.
 
 from git_command import GitCommand
+from error import GitError
+import git_cat_file
+from git_config import GitConfig
+from atomic_file import write_atomically
 import os
+import re
+import simplejson
+import threading
 
 class GitRepo(object):
-  def __init__(self, path):
+  # Optional TrackingCache shared by every repository
+  tracking_cache = None
+
+  def __init__(self, path, use_cat_file=False, project_name=None):
+    """
+    @param use_cat_file if True, revisions that can't be resolved from the
+                        ref store are looked up through a pooled, long-lived
+                        git cat-file coprocess instead of a new git process
+    @param project_name the manifest project this is, which --profile
+                        reports the repository's git commands under
+    """
     self.path = path
+    self.use_cat_file = use_cat_file
+    self.project_name = project_name
 
   def command(self, cmdv, **kwargs):
     """
@@ -33,18 +52,47 @@ class GitRepo(object):
     p = GitCommand(project=None,
                    cwd=self.path,
                    cmdv=cmdv,
+                   project_name=self.project_name,
                    **kwargs)
     return p
 
 
   def is_dirty(self):
-    return self.is_workdir_dirty() or self.is_index_dirty()
+    return self.dirty_status().dirty
 
   def is_workdir_dirty(self):
-    return self.command(["diff", "--quiet"])
+    return self.dirty_status().unstaged
 
   def is_index_dirty(self):
-    return self.command(["diff", "--quiet", "--cached"])
+    return self.dirty_status().staged
+
+  def dirty_status(self):
+    """
+    Returns a RepoStatus with only staged and unstaged filled in. This is a
+    single git status that refreshes the index once and compares it with
+    both HEAD and the work tree, without looking for untracked files or
+    counting commits. It uses core.fsmonitor when that is configured.
+    """
+    stdout = self.check_command(["status", "--porcelain=v2", "-uno",
+                                 "--no-ahead-behind"],
+                                capture_stdout=True)
+    return RepoStatus.parse(stdout)
+
+  def supports_fsmonitor(self):
+    """
+    True if this git has a builtin file system monitor for this platform.
+    Older gits read core.fsmonitor=true as the path of a hook, so this
+    needs git 2.36 or later built with the daemon, as reported by git
+    version --build-options. "fsmonitor--daemon status" must then exit 0
+    or 1, whether or not the daemon is running.
+    """
+    p = self.command_process(["version", "--build-options"],
+                             capture_stdout=True, capture_stderr=True)
+    if p.Wait() != 0 or not _has_fsmonitor_daemon(p.stdout):
+      return False
+    p = self.command_process(["fsmonitor--daemon", "status"],
+                             capture_stdout=True, capture_stderr=True)
+    return p.Wait() in (0, 1)
 
   def tracking_status(self, local_branch, remote_branch):
     """
@@ -52,37 +100,578 @@ class GitRepo(object):
     is the number of commits in the local branch and not in remote.
     The second element is the other direction
     """
-    stdout = self.check_command(["rev-list", "--left-right",
-                                 "%s...%s" % (local_branch, remote_branch)],
+    local_sha = self.rev_parse(local_branch)
+    remote_sha = self.rev_parse(remote_branch)
+    if local_sha == remote_sha:
+      return (0, 0)
+
+    cache = self.tracking_cache
+    if cache:
+      counts = cache.get(local_sha, remote_sha)
+      if counts:
+        return counts
+
+    stdout = self.check_command(["rev-list", "--left-right", "--count",
+                                 "%s...%s" % (local_sha, remote_sha)],
+                                capture_stdout=True)
+    (left, right) = stdout.split()
+    counts = (int(left), int(right))
+    if cache:
+      cache.put(local_sha, remote_sha, counts)
+    return counts
+
+  def status(self):
+    """
+    Returns a RepoStatus describing the checked out branch, its upstream
+    and the state of the index and working directory. git status itself
+    is told not to count commits; ahead/behind come from tracking_status,
+    so they are cached by commit pair.
+    """
+    stdout = self.check_command(["status", "--porcelain=v2", "--branch",
+                                 "--no-ahead-behind"],
                                 capture_stdout=True)
-    commits = stdout.strip().split("\n")
-    left_commits, right_commits = (0,0)
-    for commit in commits:
-      if not commit: continue
-      if commit[0] == '<':
-        left_commits += 1
-      else:
-        right_commits += 1
+    st = RepoStatus.parse(stdout)
+    if st.upstream and not st.upstream_gone and st.ahead is None:
+      (st.ahead, st.behind) = self.tracking_status(st.head, st.upstream)
+    return st
+
+  @property
+  def refs(self):
+    """
+    The RefStore for this repository, or None if the git directory
+    could not be found on disk.
+    """
+    if not hasattr(self, '_refs'):
+      self._refs = RefStore.for_worktree(self.path)
+    return self._refs
+
+  def object_info(self, rev):
+    """
+    Returns (sha, type, size) for the object named by rev, or None if it
+    does not exist, using the shared cat-file --batch-check coprocess.
+    """
+    return git_cat_file.pool.get(self.path,
+                                 project_name=self.project_name).info(rev)
+
+  def read_object(self, rev):
+    """
+    Returns (sha, type, data) for the object named by rev, or None if it
+    does not exist, using the shared cat-file --batch coprocess.
+    """
+    return git_cat_file.pool.get(self.path, git_cat_file.BATCH,
+                                 self.project_name).read(rev)
+
+  def _cat_file_lookup(self, rev):
+    """
+    Returns (found, sha) from the cat-file coprocess, with found None if
+    the coprocess is disabled or could not answer.
+    """
+    if not self.use_cat_file or rev.startswith("-"):
+      return (None, None)
+    try:
+      info = self.object_info(rev)
+    except GitError:
+      return (None, None)
+    if info is None:
+      return (False, None)
+    return (True, info[0])
+
+  def _commondir(self):
+    """
+    Returns the directory holding the repository's config, objects and
+    shared refs (the main git directory of a worktree), or None if there
+    is no git directory.
+    """
+    gitdir = find_gitdir(self.path)
+    if gitdir is None:
+      return None
+    if self.refs:
+      return self.refs.commondir
+    return gitdir
+
+  def config(self):
+    """
+    Returns a GitConfig for the repository's config file, read in-process.
+    Raises GitError if there is no git directory.
+    """
+    commondir = self._commondir()
+    if commondir is None:
+      raise GitError("%s is not a git repository" % self.path)
+    return GitConfig(os.path.join(commondir, "config"))
+
+  def pack_size(self):
+    """
+    Returns the total size in bytes of the repository's pack files, or 0
+    if it has none.
+    """
+    commondir = self._commondir()
+    if commondir is None:
+      return 0
+    pack_dir = os.path.join(commondir, "objects", "pack")
+    try:
+      names = os.listdir(pack_dir)
+    except OSError:
+      return 0
+    size = 0
+    for name in names:
+      if name.endswith(".pack"):
+        try:
+          size += os.path.getsize(os.path.join(pack_dir, name))
+        except OSError:
+          pass
+    return size
 
-    return (left_commits, right_commits)
+  def is_shallow(self):
+    """True if the repository is a shallow clone."""
+    commondir = self._commondir()
+    if commondir is None:
+      return False
+    return os.path.exists(os.path.join(commondir, "shallow"))
 
   def current_branch(self):
+    if self.refs:
+      target = self.refs.symbolic_ref("HEAD")
+      if target:
+        return target.replace("refs/heads/", "")
     stdout = self.check_command(["symbolic-ref", "HEAD"],
                                 capture_stdout=True)
     return stdout.rstrip().replace("refs/heads/", "")
 
+  def current_head(self):
+    """
+    Returns the checked out branch, or the sha of HEAD if it is detached,
+    so that checking out the result again restores HEAD.
+    """
+    if self.refs:
+      target = self.refs.symbolic_ref("HEAD")
+    else:
+      p = self.command_process(["symbolic-ref", "-q", "HEAD"],
+                               capture_stdout=True)
+      target = p.Wait() == 0 and p.stdout.strip() or None
+    if target and target.startswith("refs/heads/"):
+      return target[len("refs/heads/"):]
+    return self.rev_parse("HEAD")
 
   def rev_parse(self, rev):
-    stdout = self.check_command(['rev-parse', 'HEAD'],
+    if self.refs:
+      sha = self.refs.resolve(rev)
+      if sha:
+        return sha
+    (found, sha) = self._cat_file_lookup(rev)
+    if found:
+      return sha
+    stdout = self.check_command(['rev-parse', rev],
                                 capture_stdout=True)
     return stdout.rstrip()
 
   def has_ref(self, ref):
+    if self.refs and self.refs.can_resolve(ref) and not _SHA_RE.match(ref):
+      return self.refs.resolve(ref) is not None
+    (found, sha) = self._cat_file_lookup(ref)
+    if found is not None:
+      return found
     p = self.command_process(['rev-parse', '--verify', '-q', ref],
                              capture_stdout=True)
     return p.Wait() == 0
-    
+
 
   @property
   def name(self):
     return os.path.basename(os.path.realpath(self.path))
+
+
+class TrackingCache(object):
+  """
+  A persistent cache of ahead/behind counts keyed by the (local, remote)
+  commit pair. Counts for a pair of commits never change, so entries never
+  go stale; the file is simply cleared once it holds max_entries.
+  """
+  def __init__(self, path, max_entries=100000):
+    self.path = path
+    self.max_entries = max_entries
+    self.lock = threading.Lock()
+    self.entries = None
+    self.modified = False
+
+  def _load(self):
+    if self.entries is not None:
+      return
+    self.entries = {}
+    data = _read_file(self.path)
+    if data:
+      try:
+        self.entries = simplejson.loads(data)
+      except ValueError:
+        pass
+
+  def get(self, local_sha, remote_sha):
+    self.lock.acquire()
+    try:
+      self._load()
+      counts = self.entries.get("%s...%s" % (local_sha, remote_sha))
+      return counts and tuple(counts)
+    finally:
+      self.lock.release()
+
+  def put(self, local_sha, remote_sha, counts):
+    self.lock.acquire()
+    try:
+      self._load()
+      if len(self.entries) >= self.max_entries:
+        self.entries = {}
+      self.entries["%s...%s" % (local_sha, remote_sha)] = list(counts)
+      self.modified = True
+    finally:
+      self.lock.release()
+
+  def save(self):
+    """Writes the cache back out if anything was added, ignoring failures."""
+    self.lock.acquire()
+    try:
+      if not self.modified:
+        return
+      try:
+        write_atomically(self.path,
+                         lambda f: simplejson.dump(self.entries, f))
+        self.modified = False
+      except (IOError, OSError):
+        pass
+    finally:
+      self.lock.release()
+
+
+_SHA_RE = re.compile(r'^([0-9a-f]{40}|[0-9a-f]{64})$')
+_ABBREV_RE = re.compile(r'^[0-9a-f]{4,}$')
+_PSEUDOREF_RE = re.compile(r'^[A-Z_]+$')
+# Characters that make a revision an expression rather than a ref name
+_REV_EXPR_CHARS = "^~:@{}*?[\\ "
+
+class RefStore(object):
+  """
+  Resolves refs by reading HEAD, loose refs and packed-refs straight out of
+  a git directory instead of running git. Files are cached by their stat
+  signature, so repeated lookups only cost a stat() call.
+
+  resolve() returns None both for missing refs and for revisions it does
+  not understand; use can_resolve() to tell the two apart and fall back to
+  git for the latter.
+  """
+  _stores = {}
+
+  def __init__(self, gitdir):
+    self.gitdir = gitdir
+    self.commondir = gitdir
+    commondir = _read_file(os.path.join(gitdir, "commondir"))
+    if commondir:
+      self.commondir = os.path.join(gitdir, commondir.strip())
+    self._files = {}
+    self._packed = None
+    self._packed_sig = None
+
+  @staticmethod
+  def for_worktree(path):
+    """
+    Returns the (shared) RefStore for the work tree at path, or None if
+    it has no git directory we know how to read.
+    """
+    gitdir = find_gitdir(path)
+    if gitdir is None:
+      return None
+    if os.path.isdir(os.path.join(gitdir, "reftable")):
+      return None
+    gitdir = os.path.realpath(gitdir)
+    store = RefStore._stores.get(gitdir)
+    if store is None:
+      store = RefStore(gitdir)
+      RefStore._stores[gitdir] = store
+    return store
+
+  def _read(self, path):
+    try:
+      st = os.stat(path)
+    except OSError:
+      self._files.pop(path, None)
+      return None
+    sig = (st.st_mtime, st.st_size, st.st_ino)
+    cached = self._files.get(path)
+    if cached and cached[0] == sig:
+      return cached[1]
+    data = _read_file(path)
+    if data is not None:
+      data = data.strip()
+    self._files[path] = (sig, data)
+    return data
+
+  def packed_refs(self):
+    """
+    Returns a dict mapping ref name to (sha, peeled_sha) for every entry
+    in packed-refs. peeled_sha is None unless the ref is an annotated tag.
+    """
+    path = os.path.join(self.commondir, "packed-refs")
+    try:
+      st = os.stat(path)
+      sig = (st.st_mtime, st.st_size, st.st_ino)
+    except OSError:
+      sig = None
+    if self._packed is not None and sig == self._packed_sig:
+      return self._packed
+
+    packed = {}
+    last = None
+    if sig is not None:
+      for line in (_read_file(path) or "").split("\n"):
+        if not line or line[0] == '#':
+          continue
+        if line[0] == '^':
+          if last is not None:
+            packed[last] = (packed[last][0], line[1:].strip())
+          continue
+        (sha, name) = line.split(" ", 1)
+        packed[name] = (sha, None)
+        last = name
+    self._packed = packed
+    self._packed_sig = sig
+    return packed
+
+  def _ref_path(self, name):
+    if name.startswith("refs/") and not (name.startswith("refs/bisect/") or
+                                         name.startswith("refs/worktree/")):
+      return os.path.join(self.commondir, name)
+    return os.path.join(self.gitdir, name)
+
+  def read_ref(self, name, depth=0):
+    """
+    Returns the sha that the fully qualified ref name points to, following
+    symbolic refs, or None if it does not exist.
+    """
+    if depth > 5:
+      return None
+    data = self._read(self._ref_path(name))
+    if data is None:
+      entry = self.packed_refs().get(name)
+      return entry and entry[0]
+    if data.startswith("ref: "):
+      return self.read_ref(data[5:].strip(), depth + 1)
+    if _SHA_RE.match(data):
+      return data
+    return None
+
+  def symbolic_ref(self, name):
+    """
+    Returns the ref that the symbolic ref name points to, or None if it
+    is not a symbolic ref.
+    """
+    data = self._read(self._ref_path(name))
+    if data and data.startswith("ref: "):
+      return data[5:].strip()
+    return None
+
+  def can_resolve(self, rev):
+    """True if rev is something resolve() can answer authoritatively."""
+    if not rev or rev.startswith("-") or ".." in rev:
+      return False
+    for c in _REV_EXPR_CHARS:
+      if c in rev:
+        return False
+    if _ABBREV_RE.match(rev) and not _SHA_RE.match(rev):
+      return False
+    if rev == "FETCH_HEAD":
+      return False
+    return True
+
+  def resolve(self, rev):
+    """
+    Resolves rev the way git rev-parse would if it is a full sha or a
+    (possibly abbreviated) ref name. Returns None otherwise.
+    """
+    if not self.can_resolve(rev):
+      return None
+    if _SHA_RE.match(rev):
+      return rev
+    if rev.startswith("refs/") or _PSEUDOREF_RE.match(rev):
+      candidates = [rev]
+    else:
+      candidates = []
+    candidates.extend(["refs/" + rev,
+                       "refs/tags/" + rev,
+                       "refs/heads/" + rev,
+                       "refs/remotes/" + rev,
+                       "refs/remotes/%s/HEAD" % rev])
+    for name in candidates:
+      sha = self.read_ref(name)
+      if sha:
+        return sha
+    return None
+
+
+def find_gitdir(path):
+  """
+  Returns the git directory for the work tree at path, following .git
+  files, or None if there isn't one.
+  """
+  dotgit = os.path.join(path, ".git")
+  if os.path.isdir(dotgit):
+    return dotgit
+  data = _read_file(dotgit)
+  if data and data.startswith("gitdir: "):
+    return os.path.join(path, data[8:].strip())
+  return None
+
+# The first git with a builtin fsmonitor--daemon
+FSMONITOR_DAEMON_VERSION = (2, 36)
+
+def _has_fsmonitor_daemon(build_options):
+  """
+  Given the output of git version --build-options, returns True if that
+  git has the builtin fsmonitor--daemon.
+  """
+  lines = build_options.splitlines()
+  if not lines:
+    return False
+  m = re.match(r"git version (\d+)\.(\d+)", lines[0])
+  if not m or (int(m.group(1)), int(m.group(2))) < FSMONITOR_DAEMON_VERSION:
+    return False
+  return "feature: fsmonitor--daemon" in [l.strip() for l in lines[1:]]
+
+def _read_file(path):
+  try:
+    f = open(path)
+  except IOError:
+    return None
+  try:
+    return f.read()
+  finally:
+    f.close()
+
+
+class RepoStatus(object):
+  """
+  The state of a repository as reported by git status --porcelain=v2.
+
+  head is the checked out commit (None before the first commit), branch is
+  the checked out branch (None when HEAD is detached) and upstream is the
+  branch's configured upstream, if any. ahead and behind are only set when
+  the upstream exists.
+  """
+  def __init__(self):
+    self.head = None
+    self.branch = None
+    self.upstream = None
+    self.ahead = None
+    self.behind = None
+    self.has_ahead_behind = False
+    self.staged = False
+    self.unstaged = False
+    self.untracked = False
+
+  @staticmethod
+  def parse(text):
+    st = RepoStatus()
+    for line in text.split("\n"):
+      if not line:
+        continue
+      if line.startswith("# "):
+        fields = line[2:].split(" ")
+        key = fields[0]
+        if key == "branch.oid" and fields[1] != "(initial)":
+          st.head = fields[1]
+        elif key == "branch.head" and fields[1] != "(detached)":
+          st.branch = fields[1]
+        elif key == "branch.upstream":
+          st.upstream = fields[1]
+        elif key == "branch.ab":
+          st.has_ahead_behind = True
+          # With --no-ahead-behind git only says whether they differ
+          if fields[1] != "+?":
+            st.ahead = int(fields[1][1:])
+            st.behind = int(fields[2][1:])
+      elif line[0] in "12u":
+        xy = line.split(" ", 2)[1]
+        if xy[0] != ".":
+          st.staged = True
+        if xy[1] != ".":
+          st.unstaged = True
+      elif line[0] == "?":
+        st.untracked = True
+    return st
+
+  def to_dict(self):
+    return dict(self.__dict__)
+
+  @staticmethod
+  def from_dict(data):
+    st = RepoStatus()
+    for (key, value) in data.iteritems():
+      setattr(st, str(key), value)
+    return st
+
+  @property
+  def detached(self):
+    return self.branch is None
+
+  @property
+  def upstream_gone(self):
+    """True if the upstream is configured but its ref does not exist."""
+    return self.upstream is not None and not self.has_ahead_behind
+
+  @property
+  def dirty(self):
+    return self.staged or self.unstaged
+
+
+def test_parse_status():
+  st = RepoStatus.parse("""# branch.oid 7186292ae2ea444e66838ac1c12e866486c7fd11
+# branch.head master
+# branch.upstream origin/master
+# branch.ab +2 -3
+1 .M N... 100644 100644 100644 1191247b 1191247b f
+? newfile
+""")
+  assert st.head == "7186292ae2ea444e66838ac1c12e866486c7fd11"
+  assert (st.branch, st.upstream, st.ahead, st.behind) == ("master", "origin/master", 2, 3)
+  assert st.unstaged and not st.staged and st.untracked and st.dirty
+
+  st = RepoStatus.parse("# branch.head master\n# branch.upstream origin/master\n" +
+                        "# branch.ab +? -?\n")
+  assert st.ahead is None and not st.upstream_gone
+
+  st = RepoStatus.parse("# branch.oid (initial)\n# branch.head (detached)\n")
+  assert st.head is None and st.detached and not st.dirty
+
+
+def test_has_fsmonitor_daemon():
+  assert _has_fsmonitor_daemon(
+    "git version 2.39.5\ncpu: arm64\nfeature: fsmonitor--daemon\n")
+  assert _has_fsmonitor_daemon(
+    "git version 2.45.1.windows.1\nfeature: fsmonitor--daemon\n")
+  assert not _has_fsmonitor_daemon("git version 2.39.5\ncpu: x86_64\n")
+  assert not _has_fsmonitor_daemon(
+    "git version 2.35.1\nfeature: fsmonitor--daemon\n")
+  assert not _has_fsmonitor_daemon("git version 2.20.1\n")
+  assert not _has_fsmonitor_daemon("")
+
+def test_ref_store():
+  import tempfile, shutil
+  gitdir = tempfile.mkdtemp()
+  try:
+    os.makedirs(os.path.join(gitdir, "refs", "heads"))
+    a = "1" * 40
+    b = "2" * 40
+    c = "3" * 40
+    open(os.path.join(gitdir, "HEAD"), "w").write("ref: refs/heads/master\n")
+    open(os.path.join(gitdir, "refs", "heads", "master"), "w").write(a + "\n")
+    open(os.path.join(gitdir, "packed-refs"), "w").write(
+      "# pack-refs with: peeled fully-peeled sorted \n" +
+      "%s refs/remotes/origin/master\n" % b +
+      "%s refs/tags/v1\n^%s\n" % (c, a))
+    refs = RefStore(gitdir)
+    assert refs.symbolic_ref("HEAD") == "refs/heads/master"
+    assert refs.resolve("HEAD") == a
+    assert refs.resolve("master") == a
+    assert refs.resolve("origin/master") == b
+    assert refs.resolve("v1") == c
+    assert refs.packed_refs()["refs/tags/v1"] == (c, a)
+    assert refs.resolve("nope") is None and refs.can_resolve("nope")
+    assert not refs.can_resolve("HEAD~1")
+  finally:
+    shutil.rmtree(gitdir)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python2.5
+# (c) Copyright 2009 Cloudera, Inc.
+
+class JobStats(object):
+  """
+  How long each project took for each operation (init, fetch, ...) in the
+  past, kept as a moving average. Used to start the longest jobs first,
+  so that a slow project doesn't start last and set the wall time alone.
+  data is the JSON-able dict {operation: {project: seconds}}.
+  """
+  def __init__(self, data=None):
+    self.data = data or {}
+
+  def record(self, operation, name, seconds):
+    durations = self.data.setdefault(operation, {})
+    old = durations.get(name)
+    if old is None:
+      durations[name] = seconds
+    else:
+      durations[name] = (old + seconds) / 2.0
+
+  def estimates(self, operation, names, size_of=None):
+    """
+    Returns a dict mapping each of names to its expected duration. Unseen
+    projects are estimated from their size (as returned by size_of(name),
+    0 if unknown) times the median seconds per byte of the projects that
+    have been seen, or else get the median duration. If nothing has been
+    seen, the sizes themselves are the estimates.
+    """
+    known = self.data.get(operation, {})
+    sizes = {}
+    if size_of:
+      for name in names:
+        sizes[name] = size_of(name)
+
+    estimates = {}
+    rates = []
+    for name in names:
+      if name in known:
+        estimates[name] = known[name]
+        if sizes.get(name):
+          rates.append(known[name] / float(sizes[name]))
+    typical = _median(known.values())
+    rate = _median(rates)
+    for name in names:
+      if name in estimates:
+        continue
+      if sizes.get(name) and rate is not None:
+        estimates[name] = sizes[name] * rate
+      elif typical is not None:
+        estimates[name] = typical
+      else:
+        estimates[name] = sizes.get(name, 0)
+    return estimates
+
+  def longest_first(self, operation, items, size_of=None):
+    """
+    Returns items, a list of (name, ...) tuples, ordered by expected
+    duration, longest first. Ties keep their order.
+    """
+    estimates = self.estimates(operation, [item[0] for item in items],
+                               size_of)
+    return sorted(items, key=lambda item: -estimates[item[0]])
+
+
+def _median(values):
+  values = sorted(values)
+  if not values:
+    return None
+  mid = len(values) / 2
+  if len(values) % 2 == 0:
+    return (values[mid - 1] + values[mid]) / 2.0
+  return values[mid]
+
+
+def test_longest_first():
+  stats = JobStats()
+  stats.record("fetch", "big", 10.0)
+  stats.record("fetch", "small", 1.0)
+  stats.record("fetch", "small", 3.0)
+  assert stats.data["fetch"]["small"] == 2.0
+  items = [("new", None), ("small", None), ("big", None)]
+  sizes = {"big": 1000, "small": 100, "new": 500}
+  assert [n for (n, p) in stats.longest_first("fetch", items, sizes.get)] == \
+         ["big", "new", "small"]
+  # Without sizes an unseen project is assumed to be typical
+  assert [n for (n, p) in stats.longest_first("fetch", items)] == \
+         ["big", "new", "small"]
+  # Nothing seen for init: keep the order
+  assert stats.longest_first("init", items) == items
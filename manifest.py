@@ -2,17 +2,31 @@
 # (c) Copyright 2009 Cloudera, Inc.
 import simplejson
 import os
+import cPickle
+import fnmatch
+import re
+import tempfile
+from atomic_file import write_atomically
+
+# Bump whenever the pickled form of Manifest, Remote or Project changes
+CACHE_VERSION = 4
 
 class Manifest(object):
   def __init__(self,
                remotes=[],
                projects={},
                default_refspec="master",
-               default_remote="origin"):
+               default_remote="origin",
+               default_depth=None,
+               default_filter=None,
+               default_sparse=None):
     self.remotes = remotes
     self.projects = projects
     self.default_refspec = default_refspec
     self.default_remote = default_remote
+    self.default_depth = default_depth
+    self.default_filter = default_filter
+    self.default_sparse = default_sparse
 
   @staticmethod
   def from_dict(data):
@@ -21,13 +35,21 @@ class Manifest(object):
     default_remote = data.get("default_remote", "origin")
     assert default_remote in remotes
 
+    defaults = {'depth': data.get("default-depth"),
+                'filter': data.get("default-filter"),
+                'sparse': data.get("default-sparse")}
+
     projects = dict([
-      (name, Project.from_dict(name=name, data=d, remotes=remotes, default_remote=default_remote))
+      (name, Project.from_dict(name=name, data=d, remotes=remotes, default_remote=default_remote,
+                               defaults=defaults))
       for (name, d) in data.get('projects', {}).iteritems()])
     
     return Manifest(
       default_refspec=data.get("default-revision", "master"),
       default_remote=default_remote,
+      default_depth=defaults['depth'],
+      default_filter=defaults['filter'],
+      default_sparse=defaults['sparse'],
       projects=projects,
       remotes=remotes)
 
@@ -35,31 +57,131 @@ class Manifest(object):
     return simplejson.dumps(self.data_for_json(), indent=2)
 
   def data_for_json(self):
-    return {
+    data = {
       "default-revision": self.default_refspec,
       "default-remote": self.default_remote,
       "remotes": dict( [(name, remote.data_for_json()) for (name, remote) in self.remotes.iteritems()] ),
       "projects": dict( [(name, project.data_for_json()) for (name, project) in self.projects.iteritems()] ),
       }
+    for (key, value) in [("default-depth", self.default_depth),
+                         ("default-filter", self.default_filter),
+                         ("default-sparse", self.default_sparse)]:
+      if value is not None:
+        data[key] = value
+    return data
 
   def __repr__(self):
     return self.to_json()
 
+  def select(self, selectors, current_revision=None):
+    """
+    Returns a list of (name, project) pairs for the projects matched by
+    any of the selectors, or for every project if there are none. A
+    selector is one of:
+
+      NAME                 a project name (glob patterns allowed)
+      group:GROUP, @GROUP  the projects in a group
+      dir:GLOB             projects whose dir matches the glob
+      changed-since:FILE   projects whose current revision differs from
+                           the one pinned in the snapshot FILE
+
+    current_revision(project) must return a project's checked out sha
+    for changed-since selectors to work.
+    """
+    projects = self.projects.items()
+    if not selectors:
+      return projects
+
+    selected = {}
+    for selector in selectors:
+      if selector.startswith("changed-since:"):
+        pinned = load_snapshot(selector[len("changed-since:"):])
+        matches = [(n, p) for (n, p) in projects
+                   if pinned.get(n) is None or
+                   pinned.get(n) != current_revision(p)]
+      elif selector.startswith("group:") or selector.startswith("@"):
+        group = selector.split(":", 1)[-1].lstrip("@")
+        matches = [(n, p) for (n, p) in projects if group in p.groups]
+        if not matches:
+          raise Exception("No projects are in group %s" % group)
+      elif selector.startswith("dir:"):
+        pattern = selector[len("dir:"):]
+        matches = [(n, p) for (n, p) in projects
+                   if fnmatch.fnmatch(p.dir, pattern)]
+      else:
+        matches = [(n, p) for (n, p) in projects
+                   if fnmatch.fnmatch(n, selector)]
+        if not matches:
+          raise Exception("No project matches %s" % selector)
+      for (name, project) in matches:
+        selected[name] = project
+    return [(n, p) for (n, p) in projects if n in selected]
+
 
 class Remote(object):
   def __init__(self,
-               fetch):
+               fetch,
+               host=None, # groups the remote's operations; parsed from fetch by default
+               max_jobs=None, # most operations against the host at once
+               ):
     self.fetch = fetch
+    self.host = host
+    self.max_jobs = max_jobs
 
   @staticmethod
   def from_dict(data):
-    return Remote(fetch=data.get('fetch'))
+    return Remote(fetch=data.get('fetch'),
+                  host=data.get('host'),
+                  max_jobs=data.get('max-jobs'))
 
   def to_json(self):
     return simplejson.dumps(self.data_for_json(), indent=2)
 
   def data_for_json(self):
-    return {'fetch': self.fetch}
+    data = {'fetch': self.fetch}
+    if self.host is not None:
+      data['host'] = self.host
+    if self.max_jobs is not None:
+      data['max-jobs'] = self.max_jobs
+    return data
+
+  def host_for(self, project_name):
+    """
+    Returns the host the project's copy of this remote lives on, or None
+    for local remotes without a host set.
+    """
+    if self.host:
+      return self.host
+    return url_host(self.fetch % project_name)
+
+
+_URL_RE = re.compile(r'^([a-z][a-z0-9+.-]*)://(?:([^@/]*)@)?(\[[^]]*\]|[^:/]*)(?::(\d*))?', re.I)
+_SCP_RE = re.compile(r'^(?:([^@/]*)@)?(\[[^]]*\]|[^:/]+):(?!//)')
+
+def parse_url(url):
+  """
+  Returns (scheme, user, host, port) for a git URL, including the
+  scp-like user@host:path form (whose scheme is "ssh"). scheme is None
+  for local paths, and user, host and port are None when absent.
+  """
+  m = _URL_RE.match(url)
+  if m:
+    (scheme, user, host, port) = m.groups()
+    return (scheme.lower(), user, host.lower() or None, port and int(port) or None)
+  m = _SCP_RE.match(url)
+  if m and len(m.group(2)) > 1:
+    return ("ssh", m.group(1), m.group(2).lower(), None)
+  return (None, None, None, None)
+
+def url_host(url):
+  """Returns the host of a git URL, or None for local repositories."""
+  (scheme, user, host, port) = parse_url(url)
+  if scheme == "file":
+    return None
+  return host
+
+def is_ssh_url(url):
+  return parse_url(url)[0] in ("ssh", "git+ssh", "ssh+git")
 
 class Project(object):
   def __init__(self,
@@ -68,15 +190,23 @@ class Project(object):
                refspec="master", # the remote ref to pull
                from_remote="origin", # where to pull from
                dir=None,
+               groups=None,
+               depth=None, # clone and fetch only this many commits
+               filter=None, # partial clone filter, eg blob:none
+               sparse=None, # paths for sparse-checkout
                ):
     self.name = name
+    self.groups = groups if groups else []
+    self.depth = depth
+    self.filter = filter
+    self.sparse = sparse
     self.remotes = remotes if remotes else []
     self.dir = dir if dir else name
     self.from_remote = from_remote
     self.refspec = refspec
 
   @staticmethod
-  def from_dict(name, data, remotes, default_remote):
+  def from_dict(name, data, remotes, default_remote, defaults={}):
     my_remote_names = data.get('remotes', [default_remote])
     my_remotes = dict([ (r, remotes[r])
                         for r in my_remote_names])
@@ -96,6 +226,10 @@ class Project(object):
                    remotes=my_remotes,
                    refspec=data.get('refspec', 'master'),
                    dir=data.get('dir', name),
+                   groups=data.get('groups', []),
+                   depth=data.get('depth', defaults.get('depth')),
+                   filter=data.get('filter', defaults.get('filter')),
+                   sparse=data.get('sparse', defaults.get('sparse')),
                    from_remote=from_remote)
 
   @property
@@ -110,18 +244,159 @@ class Project(object):
     return simplejson.dumps(self.data_for_json())
 
   def data_for_json(self):
-    return {'name': self.name,
+    data = {'name': self.name,
             'remotes': self.remotes.keys(),
             'refspec': self.refspec,
             'from-remote': self.from_remote,
-            'dir': self.dir}
+            'dir': self.dir,
+            'groups': self.groups}
+    for key in ('depth', 'filter', 'sparse'):
+      if getattr(self, key) is not None:
+        data[key] = getattr(self, key)
+    return data
+
 
+def host_limits(man):
+  """
+  Returns a dict mapping host to the smallest max-jobs of the remotes on
+  it, for the hosts with a max-jobs.
+  """
+  limits = {}
+  for remote in man.remotes.values():
+    host = remote.host or url_host(remote.fetch)
+    if host and remote.max_jobs:
+      limits[host] = min(remote.max_jobs, limits.get(host, remote.max_jobs))
+  return limits
 
-def load_manifest(path):
+
+def load_snapshot(path):
+  """
+  Returns a dict mapping project name to the revision pinned for it in
+  the snapshot manifest at path.
+  """
   data = simplejson.load(file(path))
-  return Manifest.from_dict(data)
+  return dict([(name, d.get('revision'))
+               for (name, d) in data.get('projects', {}).iteritems()])
+
+
+_loaded = {}
+
+def load_manifest(path, cache_path=None):
+  """
+  Loads the manifest at path. Parsed manifests are memoized for the life
+  of the process, and if cache_path is given they are also stored there
+  in compiled form. Both are keyed on the manifest's path, mtime and size,
+  so the JSON is only parsed again when the file changes.
+  """
+  st = os.stat(path)
+  key = (CACHE_VERSION, os.path.abspath(path), st.st_mtime, st.st_size)
+
+  cached = _loaded.get(key[1])
+  if cached and cached[0] == key:
+    return cached[1]
+
+  man = None
+  if cache_path:
+    man = _read_cache(cache_path, key)
+  if man is None:
+    data = simplejson.load(file(path))
+    man = Manifest.from_dict(data)
+    if cache_path:
+      _write_cache(cache_path, key, man)
+
+  _loaded[key[1]] = (key, man)
+  return man
+
+def _read_cache(cache_path, key):
+  try:
+    f = open(cache_path, 'rb')
+  except IOError:
+    return None
+  try:
+    try:
+      (cached_key, man) = cPickle.load(f)
+    except Exception:
+      return None
+  finally:
+    f.close()
+  if cached_key != key:
+    return None
+  return man
+
+def _write_cache(cache_path, key, man):
+  """Atomically writes the cache file, ignoring failures."""
+  try:
+    write_atomically(cache_path,
+                     lambda f: cPickle.dump((key, man), f,
+                                            cPickle.HIGHEST_PROTOCOL),
+                     'wb')
+  except (IOError, OSError):
+    pass
 
 
 def test_json_load_store():
   man = load_manifest(os.path.join(os.path.dirname(__file__), 'test', 'test_manifest.json'))
   assert len(man.to_json()) > 10
+
+def test_select():
+  man = Manifest.from_dict({
+    "remotes": {"origin": {"fetch": "file:///%s.git"}},
+    "projects": {"hadoop": {"groups": ["core"]},
+                 "hbase": {"dir": "db/hbase", "groups": ["core", "db"]},
+                 "pig": {"dir": "tools/pig"}}})
+  def names(selectors):
+    return sorted([name for (name, project) in man.select(selectors)])
+  assert names([]) == ["hadoop", "hbase", "pig"]
+  assert names(["pig"]) == ["pig"]
+  assert names(["h*"]) == ["hadoop", "hbase"]
+  assert names(["group:db"]) == ["hbase"]
+  assert names(["@core", "pig"]) == ["hadoop", "hbase", "pig"]
+  assert names(["dir:tools/*"]) == ["pig"]
+
+def test_clone_options():
+  man = Manifest.from_dict({
+    "default-depth": 1,
+    "default-filter": "blob:none",
+    "remotes": {"origin": {"fetch": "file:///%s.git"}},
+    "projects": {"hadoop": {},
+                 "pig": {"depth": None, "sparse": ["src", "conf"]}}})
+  hadoop = man.projects["hadoop"]
+  pig = man.projects["pig"]
+  assert (hadoop.depth, hadoop.filter, hadoop.sparse) == (1, "blob:none", None)
+  assert (pig.depth, pig.filter, pig.sparse) == (None, "blob:none", ["src", "conf"])
+  assert man.data_for_json()["default-depth"] == 1
+
+def test_manifest_cache():
+  import shutil
+  path = os.path.join(os.path.dirname(__file__), 'test', 'test_manifest.json')
+  cache_dir = tempfile.mkdtemp()
+  try:
+    cache_path = os.path.join(cache_dir, 'manifest.cache')
+    _loaded.clear()
+    man = load_manifest(path, cache_path)
+    assert load_manifest(path, cache_path) is man
+    assert os.path.exists(cache_path)
+
+    _loaded.clear()
+    cached = load_manifest(path, cache_path)
+    assert cached is not man
+    assert cached.to_json() == man.to_json()
+  finally:
+    _loaded.clear()
+    shutil.rmtree(cache_dir)
+
+def test_url_host():
+  assert parse_url("ssh://git@example.com:2222/a.git") == ("ssh", "git", "example.com", 2222)
+  assert parse_url("git@Example.com:a.git") == ("ssh", "git", "example.com", None)
+  assert parse_url("https://example.com/a") == ("https", None, "example.com", None)
+  assert url_host("file:///tmp/a.git") is None
+  assert url_host("/tmp/a.git") is None
+  assert url_host("c:/a.git") is None
+  assert is_ssh_url("example.com:a") and not is_ssh_url("git://example.com/a")
+  man = Manifest.from_dict({
+    "remotes": {"origin": {"fetch": "file:///%s.git", "host": "fake", "max-jobs": 2},
+                "github": {"fetch": "git://github.com/%s.git", "max-jobs": 4}},
+    "projects": {"pig": {"remotes": ["origin", "github"]}}})
+  assert man.remotes["origin"].host_for("pig") == "fake"
+  assert man.remotes["github"].host_for("pig") == "github.com"
+  assert host_limits(man) == {"fake": 2, "github.com": 4}
@@ -0,0 +1,124 @@
+#!/usr/bin/env python2.5
+# (c) Copyright 2009 Cloudera, Inc.
+
+import fcntl
+import os
+import re
+import shutil
+import tempfile
+import threading
+try:
+  from hashlib import sha1
+except ImportError:
+  from sha import new as sha1
+from git_command import GitCommand
+
+# Environment variable naming the default mirror cache directory
+MIRROR_CACHE_ENV = 'CREPO_MIRROR_CACHE'
+
+class MirrorCache(object):
+  """
+  A directory of bare mirrors, one per remote URL, shared between
+  workspaces. Workspaces borrow objects from the mirrors with
+  --reference/alternates, and fetch from them instead of the network once
+  they are up to date. Mirrors are created and refreshed under a file lock,
+  so several crepo processes can share one cache.
+  """
+  def __init__(self, root):
+    self.root = os.path.abspath(root)
+    self.lock = threading.Lock()
+    self.url_locks = {}
+    # url -> mirror path, for mirrors refreshed by this process
+    self.refreshed = {}
+
+  def path_for(self, url):
+    """Returns where the mirror of url lives (whether or not it exists)."""
+    base = url.rstrip('/').split('/')[-1].split(':')[-1]
+    if base.endswith('.git'):
+      base = base[:-4]
+    base = re.sub(r'[^A-Za-z0-9._-]', '_', base) or 'repo'
+    return os.path.join(self.root, "%s-%s.git" % (base, sha1(url).hexdigest()[:16]))
+
+  def _url_lock(self, url):
+    self.lock.acquire()
+    try:
+      if url not in self.url_locks:
+        self.url_locks[url] = threading.Lock()
+      return self.url_locks[url]
+    finally:
+      self.lock.release()
+
+  def refresh(self, url, project_name=None):
+    """
+    Creates or updates the mirror of url, at most once per process, and
+    returns its path. Raises an Exception if that fails. project_name
+    is the project the mirror is for, as reported by --profile.
+    """
+    lock = self._url_lock(url)
+    lock.acquire()
+    try:
+      if url in self.refreshed:
+        return self.refreshed[url]
+      path = self.path_for(url)
+      if not os.path.isdir(self.root):
+        try:
+          os.makedirs(self.root)
+        except OSError:
+          if not os.path.isdir(self.root):
+            raise
+
+      lock_file = open(path + ".lock", "w")
+      try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        if os.path.isdir(path):
+          self._update(url, path, project_name)
+        else:
+          self._create(url, path, project_name)
+      finally:
+        lock_file.close()
+      self.refreshed[url] = path
+      return path
+    finally:
+      lock.release()
+
+  def _create(self, url, path, project_name=None):
+    tmp_path = tempfile.mkdtemp(dir=self.root, suffix=".tmp")
+    try:
+      p = GitCommand(None, ["clone", "--mirror", "-q", url, tmp_path],
+                     project_name=project_name)
+      if p.Wait() != 0:
+        raise Exception("Could not mirror %s" % url)
+      # Let shallow and partial clones fetch from the mirror too, and never
+      # prune objects that workspaces may be borrowing
+      for (key, value) in [("uploadpack.allowFilter", "true"),
+                           ("gc.pruneExpire", "never")]:
+        GitCommand(None, ["config", key, value], cwd=tmp_path,
+                   project_name=project_name).Wait()
+      os.rename(tmp_path, path)
+    except:
+      shutil.rmtree(tmp_path, True)
+      raise
+
+  def _update(self, url, path, project_name=None):
+    p = GitCommand(None, ["fetch", "-q", "--prune", url,
+                          "+refs/*:refs/*"], cwd=path,
+                   project_name=project_name)
+    if p.Wait() != 0:
+      raise Exception("Could not update the mirror of %s" % url)
+
+
+def from_environment():
+  """Returns the MirrorCache named by $CREPO_MIRROR_CACHE, or None."""
+  root = os.environ.get(MIRROR_CACHE_ENV)
+  if root:
+    return MirrorCache(root)
+  return None
+
+
+def test_path_for():
+  cache = MirrorCache("/cache")
+  a = cache.path_for("ssh://git@example.com/hadoop.git")
+  b = cache.path_for("ssh://git@mirror.example.com/hadoop.git")
+  assert a.startswith("/cache/hadoop-") and a.endswith(".git")
+  assert a != b
+  assert cache.path_for("git@example.com:pig").startswith("/cache/pig-")
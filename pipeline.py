@@ -0,0 +1,91 @@
+#!/usr/bin/env python2.5
+# (c) Copyright 2009 Cloudera, Inc.
+
+import sys
+from work_queue import WorkQueue
+
+class ProjectContext(object):
+  """
+  The state one project carries through a Pipeline. Steps may stash
+  whatever they like on it, and register undo actions with on_rollback.
+  """
+  def __init__(self, name, project, repo, **options):
+    self.name = name
+    self.project = project
+    self.repo = repo
+    self.undo = []
+    for (key, value) in options.iteritems():
+      setattr(self, key, value)
+
+  def on_rollback(self, func, *args):
+    """Registers func(*args) to be called if the pipeline is rolled back."""
+    self.undo.append((func, args))
+
+  def roll_back(self):
+    while self.undo:
+      (func, args) = self.undo.pop()
+      func(*args)
+
+
+class Pipeline(object):
+  """
+  Runs a sequence of steps on each project. A project goes through every
+  step back to back, while up to num_jobs projects run at once, so one
+  pass over the workspace takes about as long as its slowest project.
+  Each step is called with the project's ProjectContext and raises to
+  fail that project. If rollback is set and any project failed, every
+  project's undo actions are then run, most recent first.
+  """
+  def __init__(self, steps, num_jobs=1, rollback=True):
+    self.steps = steps
+    self.num_jobs = num_jobs
+    self.rollback = rollback
+
+  def _run_steps(self, ctx):
+    for step in self.steps:
+      step(ctx)
+
+  def run(self, contexts, out=sys.stderr):
+    """Runs the steps over contexts and returns the overall exit code."""
+    queue = WorkQueue(self.num_jobs)
+    for ctx in contexts:
+      queue.add(ctx.name, self._run_steps, ctx)
+    queue.run()
+    if queue.failures() and self.rollback:
+      self._roll_back(contexts, out)
+    return queue.report(out)
+
+  def _roll_back(self, contexts, out):
+    queue = WorkQueue(self.num_jobs)
+    for ctx in contexts:
+      if ctx.undo:
+        queue.add(ctx.name, ctx.roll_back)
+    if not queue.jobs:
+      return
+    print >>out, "Rolling back %d projects." % len(queue.jobs)
+    queue.run()
+    for job in queue.failures():
+      print >>out, "Could not roll back project %s: %s" % (job.name, job.error)
+
+
+def test_pipeline():
+  import os
+  log = []
+  def step(ctx):
+    log.append((ctx.name, "step"))
+    ctx.on_rollback(log.append, (ctx.name, "undo 1"))
+    ctx.on_rollback(log.append, (ctx.name, "undo 2"))
+    if ctx.fail:
+      raise Exception("failed")
+  contexts = [ProjectContext("a", None, None, fail=False),
+              ProjectContext("b", None, None, fail=True)]
+  devnull = open(os.devnull, "w")
+  assert Pipeline([step], num_jobs=1).run(contexts, devnull) == 1
+  assert log == [("a", "step"), ("b", "step"),
+                 ("a", "undo 2"), ("a", "undo 1"),
+                 ("b", "undo 2"), ("b", "undo 1")]
+
+  del log[:]
+  contexts = [ProjectContext("a", None, None, fail=False)]
+  assert Pipeline([step, step], num_jobs=2).run(contexts, devnull) == 0
+  assert log == [("a", "step"), ("a", "step")]
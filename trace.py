@@ -15,7 +15,11 @@
 
 import sys
 import os
+import threading
+import time
+import simplejson
 REPO_TRACE = 'REPO_TRACE'
+REPO_TRACE_FILE = 'REPO_TRACE_FILE'
 
 try:
   _TRACE = os.environ[REPO_TRACE] == '1'
@@ -32,3 +36,80 @@ def SetTrace():
 def Trace(fmt, *args):
   if IsTrace():
     print >>sys.stderr, fmt % args
+
+
+# Span records describe one finished git process: project (the manifest
+# project it was run for, or None), argv, cwd, start (seconds since the
+# epoch), duration (seconds), exit_code, stdout_bytes and stderr_bytes.
+# They are handed to every registered sink.
+_span_sinks = []
+
+def IsSpanTrace():
+  return bool(_span_sinks)
+
+def AddSpanSink(sink):
+  """Registers a callable that receives every span record."""
+  _span_sinks.append(sink)
+
+def RecordSpan(span):
+  for sink in _span_sinks:
+    sink(span)
+
+
+class JsonLinesSink(object):
+  """Appends each span record to a file as one line of JSON."""
+  def __init__(self, path):
+    self.lock = threading.Lock()
+    self.file = open(path, 'a')
+
+  def __call__(self, span):
+    line = simplejson.dumps(span) + '\n'
+    self.lock.acquire()
+    try:
+      self.file.write(line)
+      self.file.flush()
+    finally:
+      self.lock.release()
+
+
+class Profile(object):
+  """Collects span records and summarizes where the time went."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.spans = []
+    self.start = time.time()
+
+  def __call__(self, span):
+    self.lock.acquire()
+    try:
+      self.spans.append(span)
+    finally:
+      self.lock.release()
+
+  def Summary(self, out=sys.stderr, top=10):
+    spans = list(self.spans)
+    total = sum([s['duration'] for s in spans])
+    print >>out
+    print >>out, "Profile: %d git processes, %.2fs in git, %.2fs wall time" % (
+      len(spans), total, time.time() - self.start)
+
+    by_project = {}
+    by_command = {}
+    for s in spans:
+      project = s['project'] or '.'
+      by_project[project] = by_project.get(project, 0.0) + s['duration']
+      (count, secs) = by_command.get(s['command'], (0, 0.0))
+      by_command[s['command']] = (count + 1, secs + s['duration'])
+
+    print >>out, "Slowest projects:"
+    for (project, secs) in sorted(by_project.items(), key=lambda x: -x[1])[:top]:
+      print >>out, "  %8.2fs  %s" % (secs, project)
+
+    print >>out, "Time per git subcommand:"
+    for (command, (count, secs)) in sorted(by_command.items(),
+                                           key=lambda x: -x[1][1]):
+      print >>out, "  %8.2fs  %5d x  %s" % (secs, count, command)
+
+
+if os.environ.get(REPO_TRACE_FILE):
+  AddSpanSink(JsonLinesSink(os.environ[REPO_TRACE_FILE]))
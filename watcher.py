@@ -0,0 +1,144 @@
+#!/usr/bin/env python2.5
+# (c) Copyright 2009 Cloudera, Inc.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+               IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+               IN_MOVE_SELF | IN_ONLYDIR)
+_EVENT_HEADER = 'iIII'
+_EVENT_HEADER_SIZE = struct.calcsize(_EVENT_HEADER)
+
+# Returned from Watcher.changes() when events were lost and every key must
+# be considered changed
+ALL = object()
+
+class WatchError(Exception):
+  """A path could not be watched."""
+
+
+class Watcher(object):
+  """
+  Watches directories with inotify and reports which keys changed.
+  Every watched directory belongs to a key (a project, say); changes()
+  returns the keys with events since the last call. Names ending in .lock
+  are ignored, since git creates and removes those around every update.
+  """
+  def __init__(self):
+    libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+    self.libc = ctypes.CDLL(libc_name)
+    self.fd = self.libc.inotify_init()
+    if self.fd < 0:
+      raise WatchError("inotify_init failed")
+    # wd -> (key, path, recursive, skip)
+    self.watches = {}
+
+  def watch(self, path, key, recursive=False, skip=()):
+    """
+    Watches the directory path for key, and if recursive every directory
+    beneath it except those named in skip. Raises WatchError if a
+    watch could not be added (for example when out of inotify watches).
+    """
+    self._add(path, key, recursive, skip)
+    if recursive:
+      for (dirpath, dirnames, filenames) in os.walk(path):
+        dirnames[:] = [d for d in dirnames if d not in skip]
+        for d in dirnames:
+          self._add(os.path.join(dirpath, d), key, recursive, skip)
+
+  def _add(self, path, key, recursive, skip):
+    wd = self.libc.inotify_add_watch(self.fd, path, _WATCH_MASK)
+    if wd < 0:
+      raise WatchError("could not watch %s" % path)
+    self.watches[wd] = (key, path, recursive, skip)
+
+  def fileno(self):
+    return self.fd
+
+  def changes(self, timeout=None):
+    """
+    Waits up to timeout seconds for events and returns the set of keys
+    that changed, or ALL if the kernel dropped events.
+    """
+    try:
+      (readable, _, _) = select.select([self.fd], [], [], timeout)
+    except select.error, e:
+      if e[0] == errno.EINTR:
+        return set()
+      raise
+    if not readable:
+      return set()
+
+    data = os.read(self.fd, 65536)
+    changed = set()
+    pos = 0
+    while pos + _EVENT_HEADER_SIZE <= len(data):
+      (wd, mask, cookie, name_len) = struct.unpack(
+        _EVENT_HEADER, data[pos:pos + _EVENT_HEADER_SIZE])
+      pos += _EVENT_HEADER_SIZE
+      name = data[pos:pos + name_len].rstrip('\0')
+      pos += name_len
+
+      if mask & IN_Q_OVERFLOW:
+        return ALL
+      watch = self.watches.get(wd)
+      if watch is None:
+        continue
+      (key, path, recursive, skip) = watch
+      if mask & IN_IGNORED:
+        del self.watches[wd]
+        changed.add(key)
+        continue
+      if name.endswith('.lock'):
+        continue
+      changed.add(key)
+      if (recursive and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO)
+          and name not in skip):
+        try:
+          self.watch(os.path.join(path, name), key, recursive, skip)
+        except (WatchError, OSError):
+          pass
+    return changed
+
+  def close(self):
+    os.close(self.fd)
+
+
+def test_watcher():
+  import tempfile, shutil
+  try:
+    w = Watcher()
+  except (WatchError, OSError, AttributeError):
+    return
+  root = tempfile.mkdtemp()
+  try:
+    os.makedirs(os.path.join(root, "a", "sub"))
+    os.makedirs(os.path.join(root, "b"))
+    w.watch(os.path.join(root, "a"), "a", recursive=True)
+    w.watch(os.path.join(root, "b"), "b")
+    open(os.path.join(root, "a", "sub", "f"), "w").write("x")
+    assert w.changes(1.0) == set(["a"])
+    open(os.path.join(root, "b", "index.lock"), "w").write("x")
+    assert w.changes(0.1) == set()
+  finally:
+    w.close()
+    shutil.rmtree(root)
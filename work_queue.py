@@ -0,0 +1,242 @@
+#!/usr/bin/env python2.5
+# (c) Copyright 2009 Cloudera, Inc.
+
+import os
+import sys
+import threading
+import time
+import traceback
+
+def default_jobs():
+  """Returns the default number of parallel jobs (the number of cores)."""
+  try:
+    n = os.sysconf('SC_NPROCESSORS_ONLN')
+  except (AttributeError, ValueError, OSError):
+    n = 1
+  return max(1, n)
+
+
+class Job(object):
+  """
+  A single named unit of work. The function's return value is kept in
+  result; by convention an int result is an exit code, so a non-zero
+  int (or an exception) marks the job as failed.
+  """
+  def __init__(self, name, func, *args):
+    self.name = name
+    self.func = func
+    self.args = args
+    self.result = None
+    self.error = None
+    # The remote hosts the job talks to, for per-host limits
+    self.hosts = ()
+    # How long the job took to run, in seconds
+    self.duration = None
+
+  def run(self):
+    start = time.time()
+    try:
+      self.result = self.func(*self.args)
+    except Exception, e:
+      self.error = e
+      self.traceback = traceback.format_exc()
+    self.duration = time.time() - start
+
+  @property
+  def failed(self):
+    if self.error is not None:
+      return True
+    return isinstance(self.result, int) and self.result != 0
+
+  @property
+  def exit_code(self):
+    if self.error is not None:
+      return 1
+    if isinstance(self.result, int):
+      return self.result
+    return 0
+
+
+class HostSlots(object):
+  """
+  Caps how many jobs may run against each remote host at once. limits
+  maps a host to its cap, and other hosts get default; None means no cap.
+  A job holds a slot on every host in its hosts while it runs.
+  """
+  def __init__(self, default=None, limits=None):
+    self.default = default
+    self.limits = limits or {}
+    self.running = {}
+
+  def limit(self, host):
+    return self.limits.get(host, self.default)
+
+  def has_room(self, hosts):
+    for host in set(hosts):
+      limit = self.limit(host)
+      if limit is not None and self.running.get(host, 0) >= max(1, limit):
+        return False
+    return True
+
+  def acquire(self, hosts):
+    for host in set(hosts):
+      self.running[host] = self.running.get(host, 0) + 1
+
+  def release(self, hosts):
+    for host in set(hosts):
+      self.running[host] -= 1
+
+  def take_next(self, pending):
+    """
+    Removes and returns the first of pending that has room on all of its
+    hosts, acquiring its slots, or returns None if none has.
+    """
+    for (i, job) in enumerate(pending):
+      if self.has_room(job.hosts):
+        del pending[i]
+        self.acquire(job.hosts)
+        return job
+    return None
+
+
+class WorkQueue(object):
+  """
+  Runs jobs on a bounded pool of worker threads, in the order they were
+  added. With a single worker the jobs run serially in the calling
+  thread. If on_done is given it is called with each job as soon as it
+  finishes, one call at a time. If slots is given (a HostSlots), a job
+  waits while any of its hosts is at its limit, and later jobs for other
+  hosts go ahead of it.
+  """
+  def __init__(self, num_workers=1, on_done=None, slots=None):
+    self.num_workers = max(1, num_workers)
+    self.jobs = []
+    self.on_done = on_done
+    self.done_lock = threading.Lock()
+    self.slots = slots or HostSlots()
+
+  def add(self, name, func, *args):
+    job = Job(name, func, *args)
+    self.jobs.append(job)
+    return job
+
+  def _run_job(self, job):
+    job.run()
+    if self.on_done:
+      self.done_lock.acquire()
+      try:
+        self.on_done(job)
+      finally:
+        self.done_lock.release()
+
+  def run(self):
+    if self.num_workers == 1 or len(self.jobs) <= 1:
+      for job in self.jobs:
+        self._run_job(job)
+      return self.jobs
+
+    pending = list(self.jobs)
+    cond = threading.Condition()
+
+    def next_job():
+      cond.acquire()
+      try:
+        while pending:
+          job = self.slots.take_next(pending)
+          if job is not None:
+            return job
+          cond.wait()
+        return None
+      finally:
+        cond.release()
+
+    def worker():
+      while True:
+        job = next_job()
+        if job is None:
+          return
+        try:
+          self._run_job(job)
+        finally:
+          cond.acquire()
+          try:
+            self.slots.release(job.hosts)
+            cond.notifyAll()
+          finally:
+            cond.release()
+
+    threads = []
+    for i in xrange(min(self.num_workers, len(self.jobs))):
+      t = threading.Thread(target=worker)
+      t.setDaemon(True)
+      t.start()
+      threads.append(t)
+
+    # Join with a timeout so that KeyboardInterrupt still reaches us
+    for t in threads:
+      while t.isAlive():
+        t.join(0.1)
+    return self.jobs
+
+  def failures(self):
+    return [job for job in self.jobs if job.failed]
+
+  def report(self, out=sys.stderr):
+    return report_failures(self.jobs, out)
+
+
+def report_failures(jobs, out=sys.stderr):
+  """
+  Prints a summary of the failed jobs and returns the overall exit
+  code: 0 if every job succeeded, 1 otherwise.
+  """
+  failed = [job for job in jobs if job.failed]
+  if not failed:
+    return 0
+  print >>out
+  print >>out, "%d of %d projects failed:" % (len(failed), len(jobs))
+  for job in failed:
+    if job.error is not None:
+      print >>out, "  %s: %s" % (job.name, job.error)
+    else:
+      print >>out, "  %s: exit code %d" % (job.name, job.exit_code)
+  return 1
+
+
+def test_work_queue():
+  q = WorkQueue(4)
+  for i in xrange(10):
+    q.add("p%d" % i, lambda i: i % 3 == 0 and 1 or 0, i)
+  q.run()
+  assert [j.name for j in q.failures()] == ["p0", "p3", "p6", "p9"]
+  assert q.report(out=open(os.devnull, "w")) == 1
+
+  done = []
+  q = WorkQueue(3, on_done=lambda job: done.append(job.name))
+  for i in xrange(5):
+    q.add("p%d" % i, lambda: None)
+  q.run()
+  assert sorted(done) == ["p0", "p1", "p2", "p3", "p4"]
+
+def test_host_slots():
+  import time
+  lock = threading.Lock()
+  running = {}
+  peak = {}
+  def job(host):
+    lock.acquire()
+    running[host] = running.get(host, 0) + 1
+    peak[host] = max(peak.get(host, 0), running[host])
+    lock.release()
+    time.sleep(0.01)
+    lock.acquire()
+    running[host] -= 1
+    lock.release()
+
+  q = WorkQueue(6, slots=HostSlots(default=2, limits={"slow": 1}))
+  for i in xrange(12):
+    host = ["slow", "a", "b"][i % 3]
+    q.add("p%d" % i, job, host).hosts = (host,)
+  q.run()
+  assert not q.failures()
+  assert peak["slow"] == 1 and peak["a"] <= 2 and peak["b"] <= 2
@@ -0,0 +1,262 @@
+#!/usr/bin/env python2.5
+# (c) Copyright 2009 Cloudera, Inc.
+
+import errno
+import logging
+import os
+import select
+import socket
+import SocketServer
+import threading
+import simplejson
+from git_repo import GitRepo, RepoStatus
+from work_queue import WorkQueue, default_jobs
+import watcher
+
+class _ProjectState(object):
+  """
+  A project's cached status. generation is bumped on every change the
+  watcher sees; the cached status is only valid for the generation it
+  was computed at.
+  """
+  def __init__(self, name, path):
+    self.name = name
+    self.repo = GitRepo(path)
+    self.generation = 0
+    self.cached = None
+    self.watched = False
+
+  def current(self):
+    if not self.watched or self.cached is None:
+      return None
+    (generation, status) = self.cached
+    if generation != self.generation:
+      return None
+    return status
+
+  def refresh(self):
+    generation = self.generation
+    try:
+      status = self.repo.status().to_dict()
+    except Exception, e:
+      status = {"error": str(e)}
+    # If something changed while git was running, the result may already
+    # be stale; keep it, but it won't match the new generation
+    self.cached = (generation, status)
+    return status
+
+
+class WorkspaceDaemon(object):
+  """
+  Keeps the status of every project in the manifest in memory and serves
+  it over a Unix socket. Each project's .git directory, refs and work tree
+  are watched with inotify, so a project's status is only recomputed after
+  something in it changed. Without inotify every request recomputes.
+  """
+  def __init__(self, load_manifest, workdir_for_project, socket_path):
+    self.load_manifest = load_manifest
+    self.workdir_for_project = workdir_for_project
+    self.socket_path = socket_path
+    self.lock = threading.Lock()
+    self.manifest = None
+    self.projects = {}
+    self.watcher = None
+    self.server = None
+
+  def _load(self):
+    """(Re)loads the manifest and sets up watches if it has changed."""
+    man = self.load_manifest()
+    if man is self.manifest:
+      return
+    self.manifest = man
+    if self.watcher:
+      self.watcher.close()
+    try:
+      self.watcher = watcher.Watcher()
+    except (watcher.WatchError, OSError, AttributeError), e:
+      logging.warn("inotify unavailable (%s); status will not be cached" % e)
+      self.watcher = None
+
+    projects = {}
+    for (name, project) in man.projects.iteritems():
+      state = _ProjectState(name, self.workdir_for_project(project))
+      if self.watcher:
+        state.watched = self._watch(state)
+      projects[name] = state
+    self.projects = projects
+
+  def _watch(self, state):
+    path = state.repo.path
+    gitdir = os.path.join(path, ".git")
+    try:
+      self.watcher.watch(gitdir, state.name)
+      self.watcher.watch(os.path.join(gitdir, "refs"), state.name,
+                         recursive=True)
+      self.watcher.watch(path, state.name, recursive=True, skip=(".git",))
+      return True
+    except (watcher.WatchError, OSError), e:
+      logging.warn("Not caching status of %s: %s" % (state.name, e))
+      return False
+
+  def _drain(self):
+    """
+    Reads every event the kernel has queued and bumps the generation of
+    the projects they touched. Call with self.lock held, which also keeps
+    the watcher from being replaced while it is read.
+    """
+    if self.watcher is None:
+      return
+    while True:
+      changed = self.watcher.changes(0)
+      if changed is watcher.ALL:
+        for state in self.projects.values():
+          state.generation += 1
+        continue
+      if not changed:
+        return
+      for name in changed:
+        if name in self.projects:
+          self.projects[name].generation += 1
+
+  def _watch_loop(self):
+    while True:
+      w = self.watcher
+      if w is None:
+        return
+      try:
+        select.select([w], [], [], 1.0)
+      except Exception:
+        # The watcher was closed and replaced after a manifest change
+        continue
+      self.lock.acquire()
+      try:
+        self._drain()
+      finally:
+        self.lock.release()
+
+  def statuses(self, names=None):
+    """
+    Returns a dict mapping project name to its status as a dict,
+    recomputing (in parallel) only the projects that changed.
+    """
+    self.lock.acquire()
+    try:
+      self._load()
+      # Take in changes made just before this request, which the watch
+      # thread may not have read yet
+      self._drain()
+      projects = self.projects
+    finally:
+      self.lock.release()
+    if names is None:
+      names = projects.keys()
+
+    result = {}
+    queue = WorkQueue(default_jobs())
+    for name in names:
+      state = projects.get(name)
+      if state is None:
+        result[name] = {"error": "no such project"}
+        continue
+      status = state.current()
+      if status is None:
+        queue.add(name, state.refresh)
+      else:
+        result[name] = status
+    queue.run()
+    for job in queue.jobs:
+      result[job.name] = job.result
+    return result
+
+  def handle(self, request):
+    command = request.get("command")
+    if command == "status":
+      return {"projects": self.statuses(request.get("projects"))}
+    if command == "ping":
+      return {"pong": True}
+    if command == "stop":
+      threading.Thread(target=self.server.shutdown).start()
+      return {"stopped": True}
+    return {"error": "unknown command %r" % command}
+
+  def serve_forever(self):
+    if query(self.socket_path, {"command": "ping"}) is not None:
+      raise Exception("A daemon is already listening on %s" % self.socket_path)
+    if os.path.exists(self.socket_path):
+      os.unlink(self.socket_path)
+    socket_dir = os.path.dirname(self.socket_path)
+    if socket_dir and not os.path.isdir(socket_dir):
+      os.makedirs(socket_dir)
+
+    self._load()
+    watch_thread = threading.Thread(target=self._watch_loop)
+    watch_thread.setDaemon(True)
+    watch_thread.start()
+
+    daemon = self
+    class Handler(SocketServer.StreamRequestHandler):
+      def handle(self):
+        line = self.rfile.readline()
+        try:
+          response = daemon.handle(simplejson.loads(line))
+        except Exception, e:
+          response = {"error": str(e)}
+        self.wfile.write(simplejson.dumps(response) + "\n")
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+      daemon_threads = True
+
+    self.server = Server(self.socket_path, Handler)
+    try:
+      self.server.serve_forever()
+    finally:
+      self.server.server_close()
+      os.unlink(self.socket_path)
+
+
+def query(socket_path, request, timeout=30.0):
+  """
+  Sends request to the daemon listening on socket_path and returns its
+  response, or None if no daemon is running there.
+  """
+  if not os.path.exists(socket_path):
+    return None
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.settimeout(timeout)
+  try:
+    try:
+      sock.connect(socket_path)
+    except socket.error, e:
+      if e[0] in (errno.ECONNREFUSED, errno.ENOENT):
+        return None
+      raise
+    sock.sendall(simplejson.dumps(request) + "\n")
+    f = sock.makefile()
+    line = f.readline()
+    f.close()
+  finally:
+    sock.close()
+  if not line:
+    return None
+  return simplejson.loads(line)
+
+def query_statuses(socket_path, names=None):
+  """
+  Asks the daemon for project statuses. Returns a dict mapping project
+  name to RepoStatus (leaving out projects the daemon couldn't answer
+  for), or an empty dict if no daemon is running.
+  """
+  request = {"command": "status"}
+  if names is not None:
+    request["projects"] = names
+  try:
+    response = query(socket_path, request)
+  except (socket.error, ValueError):
+    return {}
+  if not response or "projects" not in response:
+    return {}
+  statuses = {}
+  for (name, data) in response["projects"].iteritems():
+    if "error" not in data:
+      statuses[name] = RepoStatus.from_dict(data)
+  return statuses